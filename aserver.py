@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# asyncio front end for a BaseHTTPRequestHandler class: the connections are
+# handled by the event loop (idle keep-alive connections cost no thread), the
+# requests are read in full and then run by the handler on a bounded thread
+# pool, writing its response back through the event loop. Long-lived
+# responses (streams) are served by coroutines on the loop instead.
+
+import io
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+
+def eprint(*args, **kwargs):
+    print(*args, **kwargs, file=sys.stderr)
+
+class LoopWriter(io.RawIOBase):
+    """
+    File-like wfile of a handler thread: the writes are done by the event
+    loop, and the thread waits for them to be drained (up to timeout seconds,
+    then the write fails as on a dead socket).
+    """
+    def __init__(self, loop, writer, timeout):
+        self.loop = loop
+        self.writer = writer
+        self.timeout = timeout
+
+    def writable(self):
+        return True
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def write(self, data):
+        data = bytes(data)
+        future = asyncio.run_coroutine_threadsafe(self._write(data), self.loop)
+        try:
+            future.result(self.timeout)
+        except Exception as e:
+            future.cancel()
+            raise BrokenPipeError(f"write failed: {e!r}")
+        return len(data)
+
+def request_path(head):
+    # of the request line, without the query
+    (method, _, rest) = head.partition(b" ")
+    target = rest.partition(b" ")[0]
+    return (method.decode("latin-1"), target.partition(b"?")[0].decode("latin-1"))
+
+def content_length(head):
+    for line in head.split(b"\r\n")[1:]:
+        (name, _, value) = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            return int(value.strip())
+    return 0
+
+class AsyncHTTPServer:
+    """
+    streams maps the paths of GET requests to the coroutines answering them
+    on the event loop, called with the StreamWriter of the connection, which
+    is closed after them.
+    """
+    def __init__(self, handler_class, address, workers=16, timeout=30, streams=None):
+        self.handler_class = handler_class
+        self.address = address
+        self.timeout = timeout
+        self.streams = streams or {}
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="http")
+
+    def handle_request(self, loop, writer, client_address, request):
+        # same as BaseHTTPRequestHandler.__init__, without the socket
+        handler = self.handler_class.__new__(self.handler_class)
+        handler.request = None
+        handler.connection = None
+        handler.client_address = client_address
+        handler.server = self
+        handler.rfile = io.BufferedReader(io.BytesIO(request))
+        handler.wfile = LoopWriter(loop, writer, self.timeout)
+        handler.close_connection = True
+        handler.handle_one_request()
+        return handler.close_connection
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info("peername")
+        try:
+            while True:
+                # the request line and the headers, then the body
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.timeout)
+                n = content_length(head)
+                if n > MAX_BODY_SIZE:
+                    break
+                body = await asyncio.wait_for(reader.readexactly(n), self.timeout) if n else b""
+                (method, path) = request_path(head)
+                if method == "GET" and path in self.streams:
+                    await self.streams[path](writer)
+                    break
+                close = await loop.run_in_executor(self.executor, self.handle_request, loop, writer, client_address, head + body)
+                if close:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        except Exception as e:
+            eprint("error while handling a connection", client_address, e)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection, *self.address, limit=MAX_HEADER_SIZE)
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
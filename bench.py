@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Benchmarks ocr.py over the test pictures: per stage wall times, the reference
+# category that succeeded and the accuracy against testdata/expected.json.
+# The output is a single JSON document, so runs can be compared over time:
+#   ./bench.py -n 5 > before.json
+
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+from collections import defaultdict, Counter
+import numpy as np
+import cv2
+import ocr
+
+TESTDATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata")
+
+def percentiles(values):
+    # in milliseconds
+    a = np.array(values) * 1000
+    return {
+        "p50": round(float(np.percentile(a, 50)), 3),
+        "p95": round(float(np.percentile(a, 95)), 3),
+        "mean": round(float(a.mean()), 3),
+        "max": round(float(a.max()), 3),
+    }
+
+def bench_image(img, repeat, engine=None):
+    totals = []
+    stages = defaultdict(list)
+    trace = None
+    for _ in range(repeat):
+        trace = ocr.Trace(os.path.basename(img))
+        start = time.perf_counter()
+        if engine:
+            value = engine.process_img(img, trace)
+        else:
+            value = ocr.process_img(img, trace)
+        totals.append(time.perf_counter() - start)
+        for (name, elapsed) in trace.stages.items():
+            stages[name].append(elapsed)
+    return (value, trace, totals, stages)
+
+def do_the_bench(imgs, expected, repeat, engine=None):
+    images = []
+    all_totals = []
+    all_stages = defaultdict(list)
+    categories = Counter()
+    correct = 0
+    for img in imgs:
+        (value, trace, totals, stages) = bench_image(img, repeat, engine)
+        category = trace.category
+        name = os.path.basename(img)
+        r = {
+            "path": img,
+            "value": value,
+            "category": category,
+            "total_ms": percentiles(totals),
+            "stages_ms": {k: percentiles(v) for (k, v) in stages.items()},
+            "counts": dict(trace.counts),
+        }
+        if name in expected:
+            r["expected"] = expected[name]
+            r["correct"] = value == expected[name]
+            correct += r["correct"]
+        images.append(r)
+        all_totals += totals
+        for (k, v) in stages.items():
+            all_stages[k] += v
+        categories[category] += 1
+        print(name, value, category, r["total_ms"]["p50"], file=sys.stderr)
+
+    checked = sum(1 for r in images if "expected" in r)
+    return {
+        "meta": {
+            "timestamp": int(time.time()),
+            "repeat": repeat,
+            "pyramid_level": ocr.PYRAMID_LEVEL,
+            "engine": bool(engine),
+            "opencv": cv2.__version__,
+        },
+        "aggregate": {
+            "images": len(images),
+            "checked": checked,
+            "correct": correct,
+            "accuracy": round(correct / checked, 4) if checked else None,
+            "latency_ms": percentiles(all_totals) if all_totals else None,
+            "stages_ms": {k: percentiles(v) for (k, v) in all_stages.items()},
+            "categories": {str(k): v for (k, v) in categories.items()},
+        },
+        "images": images,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the OCR over the test pictures")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="number of runs per image (default: 3)")
+    parser.add_argument("--expected", default=os.path.join(TESTDATA_DIR, "expected.json"), help="JSON file of the expected values by file name")
+    parser.add_argument("--level", type=int, help="pyramid level of the landmark search (default: OCR_PYRAMID_LEVEL)")
+    parser.add_argument("--engine", action="store_true", help="use a long-lived OcrEngine (with the display box cache) for all the images")
+    parser.add_argument("imgs", nargs="*", help="default: testdata/*.png testdata/*.jpg")
+    args = parser.parse_args()
+
+    # the stderr chatter of the OCR would distort the timings
+    ocr.VERBOSE = False
+    if args.level is not None:
+        ocr.PYRAMID_LEVEL = args.level
+    imgs = args.imgs or sorted(glob.glob(os.path.join(TESTDATA_DIR, "*.png"))) + sorted(glob.glob(os.path.join(TESTDATA_DIR, "*.jpg")))
+    expected = {}
+    if os.path.exists(args.expected):
+        with open(args.expected) as f:
+            expected = json.load(f)
+    engine = ocr.OcrEngine() if args.engine else None
+    print(json.dumps(do_the_bench(imgs, expected, args.repeat, engine), indent=1))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# SQLite connection management of the server: a single writer connection
+# behind a lock and a small pool of reader connections, on a database in WAL
+# mode, so the dashboard readers never block (or get blocked by) the writers.
+
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+PRAGMAS = [
+    "PRAGMA synchronous=NORMAL",  # safe in WAL mode, only the last commits may be lost on power loss
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",    # 8 MiB
+    "PRAGMA mmap_size=67108864",
+]
+
+class Database:
+    def __init__(self, path, readers=4, busy_timeout=5000):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.write_lock = threading.Lock()
+        self.writer = self._connect()
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.readers = queue.LifoQueue(readers)
+        self.free = threading.Semaphore(readers)
+        self.closed = False
+
+    def _connect(self, query_only=False):
+        # the connections are handed over between the threads, but only one of them uses one at a time
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if query_only:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    @contextmanager
+    def read(self):
+        """
+        Borrows a read-only connection from the pool (opening it if needed),
+        waiting for one if all of them are in use.
+        """
+        self.free.acquire()
+        try:
+            try:
+                conn = self.readers.get_nowait()
+            except queue.Empty:
+                conn = self._connect(query_only=True)
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                if self.closed:
+                    conn.close()
+                else:
+                    self.readers.put_nowait(conn)
+        finally:
+            self.free.release()
+
+    @contextmanager
+    def write(self):
+        """
+        The writer connection, exclusively. The transaction is committed at
+        the end of the block, or rolled back if it raises.
+        """
+        with self.write_lock:
+            try:
+                yield self.writer
+                self.writer.commit()
+            except BaseException:
+                self.writer.rollback()
+                raise
+
+    def migrate(self, migrations):
+        """
+        Brings the schema up to date: runs the migrations (lists of SQL
+        statements) that were not applied yet, each in its own transaction.
+        The number of the applied ones is kept in PRAGMA user_version.
+        Returns the number of migrations that were run.
+        """
+        with self.write() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for (i, statements) in enumerate(migrations[version:], version + 1):
+                # sqlite3 would not open a transaction for DDL statements on its own
+                conn.execute("BEGIN")
+                for sql in statements:
+                    conn.execute(sql)
+                conn.execute(f"PRAGMA user_version={i}")
+                conn.commit()
+        return max(len(migrations) - version, 0)
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self.write_lock:
+            self.writer.close()
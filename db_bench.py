@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Benchmarks the database queries of the server as the history grows:
+# minute-level temperature readings (and hourly energy data) are generated
+# for each history length, and the queries are timed with the schema of
+# server.MIGRATIONS, and without its indexes on the temperature table.
+# The output is a single JSON document:
+#   ./db_bench.py --days 7 365 1095
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+os.environ.setdefault("TAPOPLUG_IP", "")
+import server
+from db import Database
+
+def populate(database, days, now):
+    start = now - days * 86400
+    with database.write() as db:
+        db.executemany("INSERT INTO temperature (ts, temp) VALUES(?,?)",
+                       ((ts, 30 + ts // 3600 % 30) for ts in range(start, now, 60)))
+        db.executemany("INSERT OR REPLACE INTO energy_data (ts_start, ts_end, usage) VALUES(?,?,?)",
+                       ((ts, ts + 3600, ts // 3600 % 50) for ts in range(start, now, 3600)))
+
+def timed(f, repeat):
+    # in milliseconds, the best of the runs
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 3)
+
+def bench(days, indexed, repeat):
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as d:
+        database = Database(os.path.join(d, "water.db"))
+        database.migrate(server.MIGRATIONS)
+        if not indexed:
+            with database.write() as db:
+                for (name,) in list(db.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='temperature'")):
+                    db.execute(f"DROP INDEX {name}")
+        populate(database, days, now)
+        server.database = database
+        fetch_temp = lambda: server.StreamServer._fetch_temp(None, None, now)
+        fetch_energy = lambda: server.StreamServer._fetch_energy(None, None, now)
+        latest = lambda: server.StreamServer._fetch_temp(None, 1, now)
+        def recent():
+            with database.read() as db:
+                return list(db.execute("SELECT temp, ts FROM temperature WHERE ts > ? ORDER BY ts DESC LIMIT 2", (now - 3600,)))
+        r = {
+            "fetch_temp": timed(fetch_temp, repeat),
+            "fetch_energy": timed(fetch_energy, repeat),
+            "latest": timed(latest, repeat),
+            "last_hour": timed(recent, repeat),
+        }
+        database.close()
+    return r
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the database queries of the server over growing histories")
+    parser.add_argument("--days", type=int, nargs="+", default=[7, 90, 365, 1095], help="history lengths in days (default: 7 90 365 1095)")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="number of runs per query (default: 5)")
+    args = parser.parse_args()
+
+    results = []
+    for days in args.days:
+        for indexed in [False, True]:
+            r = {"days": days, "rows": days * 1440, "indexed": indexed, "ms": bench(days, indexed, args.repeat)}
+            print(json.dumps(r), file=sys.stderr)
+            results.append(r)
+    print(json.dumps({"repeat": args.repeat, "results": results}, indent=1))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Fan-out of the server's events to the Server-Sent Events subscribers. Each
+# subscriber has a bounded queue; one that does not keep up is dropped
+# instead of slowing down (or growing the memory of) the publishers.
+
+import json
+import queue
+import asyncio
+import threading
+
+class Subscriber:
+    def __init__(self, size):
+        self.queue = queue.Queue(size)
+        self.dropped = False
+
+    def offer(self, msg):
+        """
+        Queues the message, False if the subscriber is dropped instead.
+        """
+        try:
+            self.queue.put_nowait(msg)
+            return True
+        except queue.Full:
+            self.dropped = True
+            return False
+
+    def get(self, timeout=None):
+        """
+        The next event (as SSE bytes), None on timeout or once dropped.
+        """
+        if self.dropped:
+            return None
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class AsyncSubscriber:
+    """
+    Subscriber read by a coroutine on the event loop: the messages are handed
+    over to the loop, the publishers never wait for it.
+    """
+    def __init__(self, loop, size):
+        self.loop = loop
+        self.queue = asyncio.Queue(size)
+        self.dropped = False
+
+    def offer(self, msg):
+        if self.dropped:
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self._put, msg)
+        except RuntimeError:
+            # the loop is closed
+            self.dropped = True
+        return not self.dropped
+
+    def _put(self, msg):
+        try:
+            self.queue.put_nowait(msg)
+        except asyncio.QueueFull:
+            self.dropped = True
+
+    async def get(self, timeout=None):
+        """
+        The next event (as SSE bytes), None on timeout or once dropped.
+        """
+        if self.dropped:
+            return None
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+class Broadcaster:
+    def __init__(self, queue_size=100, max_subscribers=8):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.last_id = 0
+
+    def subscribe(self, loop=None):
+        """
+        A new Subscriber, an AsyncSubscriber on the loop if there is one,
+        None if there are max_subscribers already.
+        """
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            s = AsyncSubscriber(loop, self.queue_size) if loop else Subscriber(self.queue_size)
+            self.subscribers.add(s)
+            return s
+
+    def unsubscribe(self, s):
+        with self.lock:
+            self.subscribers.discard(s)
+
+    def publish(self, event, data):
+        with self.lock:
+            if not self.subscribers:
+                return
+            self.last_id += 1
+            # serialized once for all the subscribers
+            msg = f"id: {self.last_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n".encode()
+            for s in list(self.subscribers):
+                if not s.offer(msg):
+                    self.subscribers.discard(s)
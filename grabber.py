@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Keeps a single RTSP session to the camera open and maintains a ring buffer
+# of the most recent keyframes, so a reading does not need to pay for the
+# connection setup and for waiting for the next I-frame.
+
+import sys
+import time
+import struct
+import subprocess
+import threading
+from collections import deque
+import cv2
+import numpy as np
+
+def eprint(*args, **kwargs):
+    print(*args, **kwargs, file=sys.stderr)
+
+def read_bmp_frames(stream):
+    """
+    Splits an image2pipe stream of BMP files (as produced by ffmpeg -c:v bmp)
+    into individual files; the size of each is in its header.
+    """
+    while True:
+        header = stream.read(6)
+        if len(header) < 6:
+            return
+        if header[:2] != b"BM":
+            raise ValueError("not a BMP stream")
+        size = struct.unpack("<I", header[2:6])[0]
+        rest = stream.read(size - 6)
+        if len(rest) < size - 6:
+            return
+        yield header + rest
+
+def decode_bmp(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+def ffmpeg_keyframes_cmd(url, frames=None):
+    cmd = ["ffmpeg", "-rtsp_transport", "tcp", "-skip_frame", "nokey", "-i", url,
+           "-vf", "select=eq(pict_type\\,I)", "-fps_mode", "passthrough"]
+    if frames:
+        cmd += ["-frames:v", str(frames)]
+    return cmd + ["-c:v", "bmp", "-f", "image2pipe", "-"]
+
+class FrameGrabber:
+    def __init__(self, url, size=5, min_backoff=1, max_backoff=60, stall_timeout=60):
+        self.url = url
+        self.frames = deque(maxlen=size) # (timestamp, frame) tuples, the freshest one is the last
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stall_timeout = stall_timeout
+        self.cond = threading.Condition()
+        self.proc = None
+        self.thread = None
+        self.running = False
+        self.last_frame_at = 0
+        self.connected_at = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, args=(), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self._kill()
+
+    def _kill(self):
+        p = self.proc
+        if p and p.poll() is None:
+            p.kill()
+
+    def _run(self):
+        backoff = self.min_backoff
+        while self.running:
+            eprint("Frame grabber connecting to the camera")
+            self.connected_at = time.time()
+            self.proc = None
+            try:
+                # no ffmpeg, no url or no resources to start it: retried with the backoff as well
+                self.proc = subprocess.Popen(ffmpeg_keyframes_cmd(self.url), stdout=subprocess.PIPE,
+                                             stderr=subprocess.DEVNULL, start_new_session=True)
+                for data in read_bmp_frames(self.proc.stdout):
+                    frame = decode_bmp(data)
+                    if frame is None:
+                        continue
+                    with self.cond:
+                        self.last_frame_at = time.time()
+                        self.frames.append((self.last_frame_at, frame))
+                        self.cond.notify_all()
+                    backoff = self.min_backoff
+            except Exception as e:
+                eprint("Frame grabber error", e)
+            self._kill()
+            if self.proc:
+                self.proc.wait()
+            if not self.running:
+                break
+            eprint(f"Frame grabber lost the stream, reconnecting in {backoff}s")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def latest(self, newer_than=0, timeout=None):
+        """
+        Returns the freshest (timestamp, frame) taken after newer_than, waiting
+        up to timeout seconds for one to arrive. None if there is no such frame.
+        """
+        frames = self.recent(1, newer_than, timeout)
+        return frames[0] if frames else None
+
+    def recent(self, n, newer_than=0, timeout=None):
+        """
+        Returns up to n of the most recent (timestamp, frame) tuples taken after
+        newer_than, the freshest first. Waits up to timeout seconds for the
+        first one only.
+        """
+        with self.cond:
+            ok = self.cond.wait_for(lambda: self.frames and self.frames[-1][0] > newer_than, timeout)
+            if ok:
+                return [f for f in reversed(self.frames) if f[0] > newer_than][:n]
+            stalled = time.time() - max(self.last_frame_at, self.connected_at) > self.stall_timeout
+        if stalled:
+            # the session is hanging without ffmpeg noticing it, force a reconnect
+            eprint("Frame grabber stalled, restarting ffmpeg")
+            self._kill()
+        return []
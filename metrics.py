@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# Minimal in-process metrics in the Prometheus text exposition format:
+# counters, gauges (set or computed at scrape time) and histograms, with
+# labels. Recording is a lock and an addition, the formatting is only done
+# when /metrics is scraped.
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for (_, v) in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for ((k, _), v) in zip(pairs, escaped)) + "}"
+
+def format_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Metric:
+    type = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def _child(self):
+        # the metric without labels
+        return self.labels()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.type}"]
+        for (values, child) in sorted(self.children.items()):
+            lines += child.render(self.name, self.labelnames, values)
+        return lines
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def render(self, name, labelnames, values):
+        return [f"{name}{format_labels(labelnames, values)} {format_value(self.value)}"]
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return CounterValue()
+
+    def inc(self, n=1):
+        self._child().inc(n)
+
+class GaugeValue(CounterValue):
+    def __init__(self):
+        super().__init__()
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, f):
+        # computed when scraped
+        self.function = f
+
+    def render(self, name, labelnames, values):
+        value = self.value
+        if self.function:
+            try:
+                value = self.function()
+            except Exception:
+                return []
+        return [f"{name}{format_labels(labelnames, values)} {format_value(value)}"]
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self._child().set(value)
+
+    def set_function(self, f):
+        self._child().set_function(f)
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self, name, labelnames, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for (le, n) in zip(list(self.buckets) + [float("inf")], counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{format_labels(labelnames, values, [('le', format_value(le))])} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labelnames, values)} {format_value(total)}")
+        lines.append(f"{name}_count{format_labels(labelnames, values)} {cumulative}")
+        return lines
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._child().observe(value)
+
+    def time(self):
+        return self._child().time()
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines += m.render()
+        return "\n".join(lines) + "\n"
@@ -4,12 +4,21 @@ import cv2
 import sys
 import os
 import json
+import time
+import argparse
+import multiprocessing
+import threading
+import queue
+import atexit
 from sys import argv
 from collections import namedtuple
 import imutils
 from imutils.perspective import four_point_transform
 import numpy as np
-from collections import defaultdict
+import heapq
+from collections import defaultdict, Counter, OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 DIGITS_LOOKUP = {
 	(1, 1, 1, 0, 1, 1, 1): 0,
@@ -34,13 +43,101 @@ SEGMENT_NAMES = [
   "bottom",
 ]
 MIN_FLOOD_PERCENTAGE = 0.44
+
+# segments on/off as a bitmask (top is the most significant bit) -> digit, -1 if invalid
+SEGMENT_WEIGHTS = 1 << np.arange(len(SEGMENT_NAMES) - 1, -1, -1)
+DIGITS_TABLE = np.full(1 << len(SEGMENT_NAMES), -1)
+for (segments_on, digit) in DIGITS_LOOKUP.items():
+    DIGITS_TABLE[np.dot(segments_on, SEGMENT_WEIGHTS)] = digit
+
+DisplayBox = namedtuple("DisplayBox", ["category", "counter", "lx", "ty", "rx", "by", "digit_one_upper_length", "cnt_retrieval_mode"])
+
 DEBUG_DIR = os.getenv("DEBUG")
+DEBUG_FORMAT = os.getenv("DEBUG_FORMAT") or "png"
+DEBUG_MAX_PER_FRAME = int(os.getenv("DEBUG_MAX_PER_FRAME") or "0")
+DEBUG_QUEUE_SIZE = int(os.getenv("DEBUG_QUEUE_SIZE") or "64")
+VERBOSE = (os.getenv("OCR_VERBOSE") or "1") == "1"
+PYRAMID_LEVEL = int(os.getenv("OCR_PYRAMID_LEVEL") or "1")
+# largest change of the level of a segment (0-1, see display_signature) below which
+# the display is considered unchanged since the last reading; 0 turns the detection off
+UNCHANGED_THRESHOLD = float(os.getenv("OCR_UNCHANGED_THRESHOLD") or "0.25")
+UNCHANGED_MAX_HITS = int(os.getenv("OCR_UNCHANGED_MAX_HITS") or "30")
+# "segments" (decode_digits) or "template" (TemplateClassifier)
+CLASSIFIER = os.getenv("OCR_CLASSIFIER") or "segments"
+TEMPLATES_PATH = os.getenv("OCR_TEMPLATES") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates.npz")
+TEMPLATE_MIN_CONFIDENCE = float(os.getenv("OCR_TEMPLATE_MIN_CONFIDENCE") or "0.2")
+# number of threads the candidate display boxes are tried on concurrently, 0: one after the other
+THREADS = int(os.getenv("OCR_THREADS") or "0")
 
 def eprint(*args, **kwargs):
+    if not VERBOSE: return
     print(*args, **kwargs, file=sys.stderr)
 
-def img_transform(cropped_image):
-    gray = cv2.cvtColor(cropped_image, cv2.COLOR_BGR2GRAY)
+class Trace:
+    """
+    Structured record of processing a frame: the wall time of the stages (in
+    seconds, summed up if a stage runs more than once; decode is nested in the
+    attempt:<category> ones), counters (contours, attempts, retries...) and
+    values (the category that succeeded, the flood ratios of the segments...).
+    """
+    enabled = True
+
+    def __init__(self, name="frame"):
+        self.name = name
+        self.stages = defaultdict(float)
+        self.counts = Counter()
+        self.values = {}
+
+    @property
+    def category(self):
+        return self.values.get("category")
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def merge(self, other):
+        for (name, elapsed) in other.stages.items():
+            self.stages[name] += elapsed
+        self.counts.update(other.counts)
+        self.values.update(other.values)
+
+    def record(self):
+        return {"name": self.name, **self.values, "stages": dict(self.stages), "counts": dict(self.counts)}
+
+class NullTrace:
+    """
+    The default trace: records nothing, at the cost of a method call.
+    """
+    enabled = False
+    category = None
+
+    def stage(self, name):
+        return NULL_STAGE
+
+    def count(self, name, n=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def merge(self, other):
+        pass
+
+NULL_STAGE = nullcontext()
+NULL_TRACE = NullTrace()
+
+def gray_transform(gray):
     #thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU )[1]
     #blur = cv2.GaussianBlur(gray,(3,3),0)
     #thresh = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU )[1]
@@ -53,12 +150,72 @@ def img_transform(cropped_image):
     return inverted
 
 
-def save_debug_img(img, img_basepath, name):
-    if not DEBUG_DIR: return
-    idir = os.path.join(DEBUG_DIR, img_basepath)
-    if not os.path.exists(idir):
-        os.mkdir(idir)
-    cv2.imwrite(os.path.join(idir, name), img)
+class DebugWriter:
+    """
+    Writes the debug images on a background thread, through a bounded queue
+    (artifacts are dropped if it is full). Overlays are passed as a function
+    drawing on a copy of the image; that is only done by the writer thread,
+    for the artifacts that are kept. At most max_per_frame artifacts are
+    kept per frame (0: no limit). fmt is png (fast compression), png0
+    (uncompressed) or jpg.
+    """
+    def __init__(self, directory, fmt="png", max_per_frame=0, queue_size=64):
+        self.directory = directory
+        self.max_per_frame = max_per_frame
+        (self.ext, self.params) = {
+            "png": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+            "png0": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 0]),
+            "jpg": (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 90]),
+        }[fmt]
+        self.queue = queue.Queue(queue_size)
+        self.per_frame = OrderedDict()
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.thread = None
+
+    def save(self, img, img_basepath, name, draw=None):
+        # img must not be modified by the caller afterwards
+        with self.lock:
+            n = self.per_frame.pop(img_basepath, 0)
+            self.per_frame[img_basepath] = n + 1
+            if len(self.per_frame) > 100:
+                self.per_frame.popitem(last=False)
+            if self.max_per_frame and n >= self.max_per_frame:
+                self.dropped += 1
+                return
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run, args=(), daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait((img, img_basepath, name, draw))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            (img, img_basepath, name, draw) = self.queue.get()
+            try:
+                if draw:
+                    img = img.copy()
+                    draw(img)
+                idir = os.path.join(self.directory, img_basepath)
+                os.makedirs(idir, exist_ok=True)
+                cv2.imwrite(os.path.join(idir, os.path.splitext(name)[0] + self.ext), img, self.params)
+            except Exception as e:
+                eprint("failed to write debug image", name, e)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+
+debug_writer = DebugWriter(DEBUG_DIR, DEBUG_FORMAT, DEBUG_MAX_PER_FRAME, DEBUG_QUEUE_SIZE) if DEBUG_DIR else None
+if debug_writer:
+    atexit.register(debug_writer.flush)
+
+def save_debug_img(img, img_basepath, name, draw=None):
+    if not debug_writer: return
+    debug_writer.save(img, img_basepath, name, draw)
     
 def find_top_bottom(c):
 
@@ -104,77 +261,300 @@ def sort_contours(cnts, method="left-to-right"):
     return (cnts, boundingBoxes)
 
 
-def calculate_contour_distance(contour1, contour2): 
-    x1, y1, w1, h1 = cv2.boundingRect(contour1)
-    c_x1 = x1 + w1/2
-    c_y1 = y1 + h1/2
-
-    x2, y2, w2, h2 = cv2.boundingRect(contour2)
-    c_x2 = x2 + w2/2
-    c_y2 = y2 + h2/2
-
-    return max(abs(c_x1 - c_x2) - (w1 + w2)/2, abs(c_y1 - c_y2) - (h1 + h2)/2)
-
-def merge_contours(contour1, contour2):
-    return np.concatenate((contour1, contour2), axis=0)
+def contour_gaps(boxes, i=None):
+    """
+    Gap between the bounding boxes (rows of x, y, w, h); negative if they
+    overlap. Pairwise matrix, or just the row of box i if i is given.
+    """
+    cx = boxes[:, 0] + boxes[:, 2] / 2
+    cy = boxes[:, 1] + boxes[:, 3] / 2
+    w = boxes[:, 2]
+    h = boxes[:, 3]
+    if i is None:
+        return np.maximum(np.abs(cx[:, None] - cx[None, :]) - (w[:, None] + w[None, :]) / 2,
+                          np.abs(cy[:, None] - cy[None, :]) - (h[:, None] + h[None, :]) / 2)
+    return np.maximum(np.abs(cx[i] - cx) - (w[i] + w) / 2, np.abs(cy[i] - cy) - (h[i] + h) / 2)
 
 # this is borrowed from here: https://inf.news/en/news/750c405b8bcdb61dda3d24ee49855c74.html
+# the bounding boxes are computed only once and the gaps are kept in a matrix that is
+# updated incrementally on merges, so this is O(n^2) instead of O(n^3) cv2 calls.
+# Merges the closest pair (first one in scan order on ties) as long as it is closer than the threshold.
 def agglomerative_cluster(contours, threshold_distance=40.0):
-    current_contours = list(contours)
-    while len(current_contours) > 1:
-        min_distance = None
-        min_coordinate = None
-
-        for x in range(len(current_contours)-1):
-            for y in range(x+1, len(current_contours)):
-                distance = calculate_contour_distance(current_contours[x], current_contours[y])
-                if min_distance is None:
-                    min_distance = distance
-                    min_coordinate = (x, y)
-                elif distance < min_distance:
-                    min_distance = distance
-                    min_coordinate = (x, y)
-
-        if min_distance < threshold_distance:
-            index1, index2 = min_coordinate
-            current_contours[index1] = merge_contours(current_contours[index1], current_contours[index2])
-            del current_contours[index2]
-        else: 
+    n = len(contours)
+    if n < 2:
+        return list(contours)
+    groups = [[c] for c in contours]
+    boxes = np.array([cv2.boundingRect(c) for c in contours], dtype=np.float64)
+    dist = contour_gaps(boxes)
+    # only the upper triangle is considered, like the x < y scan of the original implementation
+    dist[np.tril_indices(n)] = np.inf
+    alive = np.ones(n, dtype=bool)
+    while True:
+        (index1, index2) = divmod(int(np.argmin(dist)), n)
+        if not dist[index1, index2] < threshold_distance:
             break
+        groups[index1] += groups[index2]
+        groups[index2] = None
+        alive[index2] = False
+        dist[index2, :] = np.inf
+        dist[:, index2] = np.inf
 
-    return current_contours
+        # the bounding box of the merged contour is the union of the two
+        (x1, y1, w1, h1) = boxes[index1]
+        (x2, y2, w2, h2) = boxes[index2]
+        x, y = min(x1, x2), min(y1, y2)
+        boxes[index1] = (x, y, max(x1 + w1, x2 + w2) - x, max(y1 + h1, y2 + h2) - y)
+        row = np.where(alive, contour_gaps(boxes, index1), np.inf)
+        dist[index1, index1+1:] = row[index1+1:]
+        dist[:index1, index1] = row[:index1]
 
-def process_img(img_path):
-    img_basepath = os.path.basename(img_path)
-    test_img = cv2.imread(img_path)
-    
-    
-    # pre-process the image by resizing it, converting it to
-    # graycale, blurring it, and computing an edge map
-    image = imutils.resize(test_img, height=1080)
-    save_debug_img(image, img_basepath, "00-input.png")
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    blurred = cv2.GaussianBlur(gray, (11, 11), 0)
+    return [g[0] if len(g) == 1 else np.concatenate(g, axis=0) for g in groups if g is not None]
+
+def process_img(img_path, trace=NULL_TRACE):
+    with trace.stage("load"):
+        test_img = cv2.imread(img_path)
+    return process_frame(test_img, os.path.basename(img_path), os.getenv("SAVE_DISPLAY_PATH"), trace)
+
+def segment_boxes(w, h, thin):
+    """
+    The boxes (xA, yA, xB, yB) of the 7 segments of a w*h digit, plus the
+    bottom segment shifted up a bit (retried if the bottom of the display is noisy).
+    """
+    (dW, dH) = (int(w * 0.21), int(h * 0.15))
+    dHC = int(h * 0.05)
+
+    if thin:
+        # this is super thin, probably digit 1. 20% is not enough
+        dW = dW * 3
+
+    return [
+        (0, 0, w, dH),                                        # top
+        (0, 0, dW, h // 2),                                   # top-left
+        (w - dW, 0, w, h // 2),                               # top-right
+        (0, (h // 2) - dHC, w, (h // 2) + dHC),               # center
+        (0, h // 2, dW, h),                                   # bottom-left
+        (w - int(dW * 1.2), h // 2, w - int(dW * 0.2), h),    # bottom-right
+        (0, h - int(dH*1.0), w, h - int(dH*0.0)),             # bottom
+        (0, h - int(dH*1.3), w, h - int(dH*0.3)),             # bottom, retry
+    ]
+
+def decode_digits(rois, thin, trace=NULL_TRACE):
+    """
+    Decodes the thresholded digit ROIs: the segments of all the digits are
+    scored in one step on a stack of their integral images and looked up in
+    DIGITS_TABLE. Returns the digits (-1 where it is not a valid one) and the
+    segment boxes.
+    """
+    n = len(rois)
+    ii = np.zeros((n, max(r.shape[0] for r in rois) + 1, max(r.shape[1] for r in rois) + 1), dtype=np.int32)
+    boxes = np.zeros((n, len(SEGMENT_NAMES) + 1, 4), dtype=np.int32)
+    for (k, roi) in enumerate(rois):
+        (h, w) = roi.shape
+        ii[k, :h + 1, :w + 1] = cv2.integral((roi != 0).astype(np.uint8))
+        boxes[k] = np.clip(segment_boxes(w, h, thin[k]), 0, [w, h, w, h])
+
+    (xA, yA, xB, yB) = np.moveaxis(boxes, 2, 0)
+    k = np.arange(n)[:, None]
+    total = ii[k, yB, xB] - ii[k, yA, xB] - ii[k, yB, xA] + ii[k, yA, xA]
+    area = (xB - xA) * (yB - yA)
+    # if the total number of non-zero pixels is greater than
+    # MIN_FLOOD_PERCENTAGE of the area, mark the segment as "on"
+    flood = total / area
+    lit = flood > MIN_FLOOD_PERCENTAGE
+    on = lit[:, :len(SEGMENT_NAMES)].copy()
+
+    # super thin digits are probably 1s. the horizontal ones dont make a sense here
+    t = np.asarray(thin, dtype=bool)
+    on[t, 2] |= on[t, 1]
+    on[t, 5] |= on[t, 4]
+    on[np.ix_(t, [0, 1, 3, 4, 6])] = False
+
+    digits = DIGITS_TABLE[on @ SEGMENT_WEIGHTS]
+    # the bottom of the display may have some noise, trying to workaround it
+    # (a retried digit must not be 0)
+    retry = digits < 0
+    trace.count("retries", int(retry.sum()))
+    on[retry, 6] |= lit[retry, 7]
+    retried = DIGITS_TABLE[on @ SEGMENT_WEIGHTS]
+    digits = np.where(retry, np.where(retried > 0, retried, -1), digits)
+    for d in range(n):
+        eprint("flood", d + 1, np.round(flood[d], 3).tolist(), on[d].astype(int).tolist(), digits[d])
+    if trace.enabled:
+        trace.set("flood", np.round(flood, 3).tolist())
+    return (digits.tolist(), boxes)
+
+TEMPLATE_SIZE = (12, 20)
+# weight of the aspect ratio of the ROI among the pixels: a "1" is thin,
+# but it fills the whole grid once resized
+TEMPLATE_ASPECT_WEIGHT = 8
+
+def digit_vectors(rois):
+    """
+    Feature vectors of the thresholded digit ROIs (one row each): the ROI
+    resized to TEMPLATE_SIZE and its aspect ratio.
+    """
+    x = np.zeros((len(rois), TEMPLATE_SIZE[0] * TEMPLATE_SIZE[1] + 1), dtype=np.float32)
+    for (k, roi) in enumerate(rois):
+        x[k, :-1] = cv2.resize(roi, TEMPLATE_SIZE, interpolation=cv2.INTER_AREA).ravel() / 255
+        x[k, -1] = TEMPLATE_ASPECT_WEIGHT * roi.shape[1] / roi.shape[0]
+    return x
+
+class TemplateClassifier:
+    """
+    Nearest-template digit classifier. The templates are digit_vectors of
+    labelled digits (see build_templates); the distances of all the digits
+    to all the templates are computed in one matrix operation.
+    """
+    def __init__(self, templates, labels):
+        self.templates = np.asarray(templates, dtype=np.float32)
+        self.labels = np.asarray(labels)
+        self.norms = (self.templates ** 2).sum(axis=1)
+        self.classes = np.unique(self.labels)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["templates"], f["labels"])
+
+    def save(self, path):
+        np.savez_compressed(path, templates=self.templates, labels=self.labels)
+
+    def classify(self, rois):
+        """
+        Returns the digits and the confidence of the weakest one: how much
+        farther the nearest template of the runner-up digit is than the
+        nearest one of the chosen digit (0: ambiguous, 1: exact match).
+        """
+        x = digit_vectors(rois)
+        dist = np.sqrt(np.maximum((x ** 2).sum(axis=1)[:, None] - 2 * x @ self.templates.T + self.norms, 0))
+        # nearest template of each digit class
+        per_class = np.stack([dist[:, self.labels == c].min(axis=1) for c in self.classes], axis=1)
+        order = np.argsort(per_class, axis=1)
+        rows = np.arange(len(rois))
+        best = per_class[rows, order[:, 0]]
+        second = per_class[rows, order[:, 1]]
+        confidence = 1 - best / np.maximum(second, 1e-6)
+        return ([int(d) for d in self.classes[order[:, 0]]], float(confidence.min()))
+
+_template_classifier = None
+
+def template_classifier():
+    """
+    The TemplateClassifier if OCR_CLASSIFIER is "template", loaded once.
+    """
+    global _template_classifier
+    if CLASSIFIER != "template":
+        return None
+    if _template_classifier is None:
+        _template_classifier = TemplateClassifier.load(TEMPLATES_PATH)
+    return _template_classifier
+
+def build_templates(imgs, expected):
+    """
+    Collects the digit ROIs of the pictures that the segment decoder reads
+    as expected (a dict of the values by file name), labelled with their
+    digits.
+    """
+    templates = []
+    labels = []
+    for img in imgs:
+        value = expected.get(os.path.basename(img))
+        if value is None:
+            continue
+        engine = OcrEngine(unchanged_threshold=0)
+        test_img = cv2.imread(img)
+        if engine.process_frame(test_img) != value:
+            eprint("skipping", img)
+            continue
+        found = find_digit_rois(prepare_frame(test_img), engine.cached_box)
+        templates.append(digit_vectors(found[2]))
+        labels += [int(d) for d in str(value)]
+    return TemplateClassifier(np.concatenate(templates), labels)
+
+def prepare_frame(test_img):
+    return imutils.resize(test_img, height=1080)
+
+def segment_layout(image, box):
+    """
+    The segment boxes of the digits on the display box of the (already
+    resized) frame, in the coordinates of the cropped display: an array of
+    (xA, yA, xB, yB) rows, 7 per digit. None if there are no digits.
+    """
+    found = find_digit_rois(image, box)
+    if found is None:
+        return None
+    layout = []
+    for (x, y, w, h) in found[1]:
+        boxes = np.clip(segment_boxes(w, h, w < box.digit_one_upper_length), 0, [w, h, w, h])[:len(SEGMENT_NAMES)]
+        layout.append(boxes + [x, y, x, y])
+    return np.concatenate(layout)
+
+def display_signature(test_img, box, layout):
+    """
+    The mean brightness of each segment of the layout (see segment_layout),
+    scaled between the darkest and the brightest one, to tell cheaply whether
+    the display changed: a segment turning on or off moves its level by about
+    1, lighting changes are mostly normalized away. The box is in
+    prepare_frame coordinates, so it is mapped back onto the original frame
+    instead of resizing the whole frame. None if the box is outside of it or
+    the segments all look the same.
+    """
+    scale = test_img.shape[0] / 1080
+    crop = test_img[int(box.ty * scale):int(box.by * scale), int(box.lx * scale):int(box.rx * scale)]
+    if crop.size == 0:
+        return None
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    ii = cv2.integral(gray)
+    (h, w) = gray.shape
+    (xA, yA, xB, yB) = np.clip((layout * scale).astype(int), 0, [w, h, w, h]).T
+    total = ii[yB, xB] - ii[yA, xB] - ii[yB, xA] + ii[yA, xA]
+    levels = total / np.maximum((xB - xA) * (yB - yA), 1)
+    span = levels.max() - levels.min()
+    if span < 1:
+        return None
+    return (levels - levels.min()) / span
+
+def odd(n):
+    n = max(int(n), 1)
+    return n if n % 2 else n + 1
+
+def edge_map(gray, scale=1):
+    # pre-process the grayscale image by blurring it, thresholding it
+    # and computing an edge map. The kernels are for the 1080p frame,
+    # they are scaled down for the smaller pyramid levels (pyrDown blurs
+    # on its own already).
+    k = 11 if scale == 1 else odd(11 / (2 * scale))
+    blurred = cv2.GaussianBlur(gray, (k, k), 0)
     
-    thresh = cv2.adaptiveThreshold(blurred,255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 37, -30)    
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (1, 5))
+    thresh = cv2.adaptiveThreshold(blurred,255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, odd(37 / scale), -30)    
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (1, odd(5 / scale)))
     thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
     
-    edged = cv2.Canny(thresh, 50, 200, 255)
-    save_debug_img(edged, img_basepath, "01-edged.png")
-    
-    # find contours in the edge map, then sort them by their
-    # size in descending order
-    cnts = cv2.findContours(edged.copy(), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    return cv2.Canny(thresh, 50, 200, 255)
+
+def display_box_candidates(image, img_basepath="frame", trace=NULL_TRACE):
+    """
+    The display boxes found on PYRAMID_LEVEL, followed by the ones found on
+    the full resolution frame (that were not tried yet) as a fallback.
+    """
+    tried = set()
+    for level in sorted({PYRAMID_LEVEL, 0}, reverse=True):
+        for box in find_display_boxes(image, img_basepath, level, trace):
+            if box[2:] in tried:
+                continue
+            tried.add(box[2:])
+            yield box
+
+def find_reference_contours(edged, scale, image, img_basepath="frame", trace=NULL_TRACE):
+    """
+    Classifies the 10 largest contours of the edge map (of the given scale)
+    into the reference categories. Returns the contours (in 1080p coordinates)
+    by category and the vertical shifts of the curly stuff.
+    """
+    cnts = cv2.findContours(edged, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
     cnts = imutils.grab_contours(cnts)
-    cnts = sorted(cnts, key=cv2.contourArea, reverse=True)
-    ariston_logo_cnt = None
-    manual_displaybox_cnt = None
-    top_helper_cnt = None
-    outer_top_helper_cnt = None
-    top_line_cnt = None
-    left_curly_stuff_cnt = None
-    
+    trace.count("contours", len(cnts))
+    cnts = heapq.nlargest(10, cnts, key=cv2.contourArea)
     reference_cnts = defaultdict(list)
     
     left_curly_ty_shift = 0
@@ -183,38 +563,38 @@ def process_img(img_path):
     i = 0
     for c in cnts:
         i+= 1
-        if i > 10:
-            break
-        if DEBUG_DIR:
-            aimage = image.copy()
-            cv2.polylines(aimage, c, True, color, 3)
-            save_debug_img(aimage, img_basepath, "02-logocandidates-"+str(i)+".png")
+        # the rules below are in the pixels of the 1080p frame
+        c = c * scale
+        save_debug_img(image, img_basepath, "02-logocandidates-"+str(i)+".png",
+                       lambda aimage, c=c: cv2.polylines(aimage, c, True, color, 3))
         # approximate the contour
         peri = cv2.arcLength(c, True)
         approx = cv2.approxPolyDP(c, 0.02 * peri, True)
         (x, y, w, h) = cv2.boundingRect(approx)
         l = len(approx)
-        eprint("contour for log candidate", i, l, len(c), c[0][0][0], w, h)
+        # the number of points of a contour is proportional to its size
+        npoints = len(c) * scale
+        eprint("contour for log candidate", i, l, npoints, c[0][0][0], w, h)
         if l in [3, 4] and w > 1313 and w < 1450 and h > 80 and h < 120:
             eprint("potential top line found")
             reference_cnts["top_line"].append(c)
-        elif l == 6 and len(c) > 300 and c[0][0][0] < 600 and w > 300 and w < 340 and h > 125 and h < 150:
+        elif l == 6 and npoints > 300 and c[0][0][0] < 600 and w > 300 and w < 340 and h > 125 and h < 150:
             eprint("potential left_curly_stuff_cnt found")
             reference_cnts["left_curly_stuff"].append(c)
             left_curly_ty_shift = 0
-        elif l == 6 and len(c) > 200 and c[0][0][0] < 600 and w > 220 and w < 260 and h > 125 and h < 150:
+        elif l == 6 and npoints > 200 and c[0][0][0] < 600 and w > 220 and w < 260 and h > 125 and h < 150:
             eprint("potential left_curly_stuff_cnt 2 found")
             reference_cnts["left_curly_stuff"].append(c)
             left_curly_ty_shift = 10
-        elif l == 7 and len(c) > 200 and c[0][0][0] < 600 and w > 220 and w < 260 and h > 125 and h < 150:
+        elif l == 7 and npoints > 200 and c[0][0][0] < 600 and w > 220 and w < 260 and h > 125 and h < 150:
             eprint("potential left_curly_stuff_cnt 3 found")
             reference_cnts["left_curly_stuff"].append(c)
             left_curly_ty_shift = 14
-        elif l == 6 and len(c) > 230 and c[0][0][0] > 600 and w > 300 and w < 340 and h > 125 and h < 150:
+        elif l == 6 and npoints > 230 and c[0][0][0] > 600 and w > 300 and w < 340 and h > 125 and h < 150:
             eprint("potential right_curly_stuff_cnt found")
             reference_cnts["right_curly_stuff"].append(c)
             right_curly_ty_shift = -20
-        elif l >= 6 and l <= 7 and len(c) > 180 and c[0][0][0] > 600 and w > 250 and w < 300 and h > 125 and h < 160:
+        elif l >= 6 and l <= 7 and npoints > 180 and c[0][0][0] > 600 and w > 250 and w < 300 and h > 125 and h < 160:
             eprint("potential right_curly_stuff_cnt 2 found")
             reference_cnts["right_curly_stuff"].append(c)
             right_curly_ty_shift = 5
@@ -231,7 +611,30 @@ def process_img(img_path):
         elif reference_cnts.get("ariston_logo") is None and l in [5,6] and w < 100:
             eprint("potential ariston logo found")
             reference_cnts["ariston_logo"].append(c)
+    return (reference_cnts, left_curly_ty_shift, right_curly_ty_shift)
 
+def find_display_boxes(image, img_basepath="frame", level=None, trace=NULL_TRACE):
+    """
+    Landmark search over the whole (already resized) frame. Yields the
+    candidate display boxes in the order they should be tried.
+    The search runs on the given level of the image pyramid (each level is
+    half the size of the previous one); the candidate contours are scaled
+    back, so the boxes are always in the coordinates of image.
+    """
+    if level is None:
+        level = PYRAMID_LEVEL
+    scale = 2 ** level
+    with trace.stage("edge_map"):
+        small = image
+        for _ in range(level):
+            small = cv2.pyrDown(small)
+        edged = edge_map(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), scale)
+    save_debug_img(edged, img_basepath, "01-edged.png")
+    
+    # find contours in the edge map, then keep the 10 largest
+    # ones in descending order
+    with trace.stage("contours"):
+        (reference_cnts, left_curly_ty_shift, right_curly_ty_shift) = find_reference_contours(edged, scale, image, img_basepath, trace)
     eprint("potential reference point categories", reference_cnts.keys())
     cnt_counter = 0
     for reference_category in ["left_curly_stuff",  "right_curly_stuff", "outer_top_helper_new_pos", "outer_top_helper", "top_helper", "top_line", "manual_display", "ariston_logo"]:
@@ -340,145 +743,310 @@ def process_img(img_path):
                 raise Exception("should never happen")
                 
             eprint("digit_one_length", digit_one_upper_length)
-            display_box = np.array([
-                [ display_lx, display_ty ],  # top left
-                [ display_rx, display_ty ],  # top right
-                [ display_rx, display_by ],  # bottom right
-                [ display_lx, display_by ],  # bottom left
-            ])
-
-            if DEBUG_DIR:
-                eprint("display box", reference_category, display_box)
-                aimage = image.copy()
-                cv2.polylines(aimage, [display_box], True, color, 3)
-                save_debug_img(aimage, img_basepath, f"04-{reference_category}-{cnt_counter}-display-box-on-full.png")
-
-            cropped_test_img = image[display_ty:display_by, display_lx:display_rx]    
-            save_display_pic = os.getenv("SAVE_DISPLAY_PATH")
-            if save_display_pic:
-                cv2.imwrite(save_display_pic, cropped_test_img)
-            save_debug_img(cropped_test_img, img_basepath, f"05-{reference_category}-{cnt_counter}-cropped-display-box.png")
-            thresh_cropped_test_img = img_transform(cropped_test_img)
-            save_debug_img(thresh_cropped_test_img, img_basepath, f"06-{reference_category}-{cnt_counter}-cropped-threshed-display-box.png")
-
-            # find contours in the thresholded image, then initialize the
-            # digit contours lists
-            cnts = cv2.findContours(thresh_cropped_test_img.copy(), cnt_retrieval_mode, cv2.CHAIN_APPROX_SIMPLE)
-            cnts = imutils.grab_contours(cnts)
-            
-            # sometimes when the picture is excellent quality we need to merge close contours
-            if len(cnts) >= 8:
-                cnts = agglomerative_cluster(cnts, 3)
-            
-            digitCnts = []
-            # loop over the digit area candidates
-            d = 0
-            for c in cnts:
-                d += 1
-                # compute the bounding box of the contour
-                (x, y, w, h) = cv2.boundingRect(c)
-                if DEBUG_DIR:
-                    eprint("digit contour", d, x, y, w, h)
-                    aimage = cropped_test_img.copy()
-                    cv2.polylines(aimage, c, True, color, 3)
-                    save_debug_img(aimage, img_basepath, f"07-{reference_category}-{cnt_counter}-digit-cnt-{d}.png")
-
-                # if the contour is sufficiently large, it must be a digit
-                if (w >= 10 and w <= 62) and (h >= 44 and h <= 85):
-                    eprint("saving digit", d, x, y, w, h)
-                    digitCnts.append(c)
-            if len(digitCnts) < 2:
-                eprint("we didn't find enough digits")
-                continue
-            digitCnts = sort_contours(digitCnts, method="left-to-right")[0]
-            result = ""
-            failure = False
-            d = 0
-            # loop over each of the digits
-            for c in digitCnts:
-                d+=1
-                if d > 2:
-                    break
-                # extract the digit ROI
-                (x, y, w, h) = cv2.boundingRect(c)
-                eprint("bounding", d, x, y, w, h)
-                color_roi = cropped_test_img[y:y + h, x:x + w]
-                roi = img_transform(color_roi)
-                if DEBUG_DIR:
-                    save_debug_img(roi, img_basepath, f"07-{reference_category}-{cnt_counter}-digit-d{d}.png")
-
-                # compute the width and height of each of the 7 segments
-                # we are going to examine
-                (roiH, roiW) = roi.shape
-                (dW, dH) = (int(roiW * 0.21), int(roiH * 0.15))
-                dHC = int(roiH * 0.05)
-                
-                if w < digit_one_upper_length:
-                    # this is super thin, probably digit 1. 20% is not enough
-                    dW = dW * 3
-
-                # define the set of 7 segments
-                segments = [
-                    ((0, 0), (w, dH)),	                         # top
-                    ((0, 0), (dW, h // 2)),	                     # top-left
-                    ((w - dW, 0), (w, h // 2)),	                 # top-right
-                    ((0, (h // 2) - dHC) , (w, (h // 2) + dHC)), # center
-                    ((0, h // 2), (dW, h)),	                     # bottom-left
-                    ((w - int(dW * 1.2), h // 2), (w- int(dW * 0.2), h)),	                 # bottom-right
-                    ((0, h - int(dH*1.0)), (w, h-int(dH*0.0)))                        # bottom
-                ]
-                on = [0] * len(segments)
-                
-                # loop over the segments
-                for (i, ((xA, yA), (xB, yB))) in enumerate(segments):
-                    if DEBUG_DIR:
-                        acolor_roi = cv2.rectangle(color_roi.copy(), (xA, yA), (xB, yB), (0, 0, 255), 2)
-                        save_debug_img(acolor_roi, img_basepath, f"07-{reference_category}-{cnt_counter}-digit-d{d}-{i}.png")
-                    # extract the segment ROI, count the total number of
-                    # thresholded pixels in the segment, and then compute
-                    # the area of the segment
-                    segROI = roi[yA:yB, xA:xB]
-                    total = cv2.countNonZero(segROI)
-                    area = (xB - xA) * (yB - yA)
-
-                    # if the total number of non-zero pixels is greater than
-                    # 50% of the area, mark the segment as "on"
-                    eprint("flood", d, i, SEGMENT_NAMES[i], total / float(area))
-                    if total / float(area) > MIN_FLOOD_PERCENTAGE:
-                        on[i]= 1
-
-                if w < digit_one_upper_length: # this is super thin, probably digit 1. the horizontal ones dont make a sense here
-                    on[0] = 0 # top
-                    on[3] = 0 # center
-                    on[6] = 0 # bottom
-                    on[2] = 1 if on[1] or on[2] else 0
-                    on[5] = 1 if on[4] or on[5] else 0
-                    on[1] = 0
-                    on[4] = 0
-
-                # lookup the digit and draw it on the image
-                digit = DIGITS_LOOKUP.get(tuple(on))
-                eprint("digits slices", on, digit)
-                if digit is None:
-                    # the bottom of the display may have some noise, trying to workaround it
-                    (xA, yA), (xB, yB) = ((0, h - int(dH*1.3)), (w, h-int(dH*0.3)))
-                    segROI = roi[yA:yB, xA:xB]
-                    total = cv2.countNonZero(segROI)
-                    area = (xB - xA) * (yB - yA)
-
-                    # if the total number of non-zero pixels is greater than
-                    # 50% of the area, mark the segment as "on"
-                    eprint("retried flood", d, i, SEGMENT_NAMES[i], total / float(area))
-                    if total / float(area) > MIN_FLOOD_PERCENTAGE:
-                        on[i]= 1
-                    digit = DIGITS_LOOKUP.get(tuple(on))
-                    if not digit:
-                        failure = True
-                        break
-                result += str(digit)
-            if failure:
-                continue
-            return int(result)
+            yield DisplayBox(reference_category, cnt_counter, display_lx, display_ty, display_rx, display_by,
+                             digit_one_upper_length, cnt_retrieval_mode)
+
+def find_digit_rois(image, box, img_basepath="frame", trace=NULL_TRACE):
+    """
+    Crops the display box out of the (already resized) frame and finds the
+    first two digits on it. Returns the cropped display, the bounding rects
+    of the digits and their thresholded ROIs, or None if there are no digits.
+    """
+    (reference_category, cnt_counter, display_lx, display_ty, display_rx, display_by,
+     digit_one_upper_length, cnt_retrieval_mode) = box
+    color = (0, 0, 255)
+    display_box = np.array([
+        [ display_lx, display_ty ],  # top left
+        [ display_rx, display_ty ],  # top right
+        [ display_rx, display_by ],  # bottom right
+        [ display_lx, display_by ],  # bottom left
+    ])
+
+    if DEBUG_DIR:
+        eprint("display box", reference_category, display_box)
+        save_debug_img(image, img_basepath, f"04-{reference_category}-{cnt_counter}-display-box-on-full.png",
+                       lambda aimage: cv2.polylines(aimage, [display_box], True, color, 3))
+
+    cropped_test_img = image[display_ty:display_by, display_lx:display_rx]    
+    if cropped_test_img.size == 0:
+        eprint("display box is outside of the frame")
+        return None
+    save_debug_img(cropped_test_img, img_basepath, f"05-{reference_category}-{cnt_counter}-cropped-display-box.png")
+    gray_cropped_test_img = cv2.cvtColor(cropped_test_img, cv2.COLOR_BGR2GRAY)
+    thresh_cropped_test_img = gray_transform(gray_cropped_test_img)
+    save_debug_img(thresh_cropped_test_img, img_basepath, f"06-{reference_category}-{cnt_counter}-cropped-threshed-display-box.png")
+
+    # find contours in the thresholded image, then initialize the
+    # digit contours lists
+    cnts = cv2.findContours(thresh_cropped_test_img.copy(), cnt_retrieval_mode, cv2.CHAIN_APPROX_SIMPLE)
+    cnts = imutils.grab_contours(cnts)
+    trace.count("display_contours", len(cnts))
+
+    # sometimes when the picture is excellent quality we need to merge close contours
+    if len(cnts) >= 8:
+        with trace.stage("cluster"):
+            cnts = agglomerative_cluster(cnts, 3)
+
+    digitCnts = []
+    # loop over the digit area candidates
+    d = 0
+    for c in cnts:
+        d += 1
+        # compute the bounding box of the contour
+        (x, y, w, h) = cv2.boundingRect(c)
+        if DEBUG_DIR:
+            eprint("digit contour", d, x, y, w, h)
+            save_debug_img(cropped_test_img, img_basepath, f"07-{reference_category}-{cnt_counter}-digit-cnt-{d}.png",
+                           lambda aimage, c=c: cv2.polylines(aimage, c, True, color, 3))
+
+        # if the contour is sufficiently large, it must be a digit
+        if (w >= 10 and w <= 62) and (h >= 44 and h <= 85):
+            eprint("saving digit", d, x, y, w, h)
+            digitCnts.append(c)
+    if len(digitCnts) < 2:
+        eprint("we didn't find enough digits")
+        return None
+    digitCnts = sort_contours(digitCnts, method="left-to-right")[0]
+    # only the first two digits are read
+    rects = [cv2.boundingRect(c) for c in digitCnts[:2]]
+    rois = []
+    for (d, (x, y, w, h)) in enumerate(rects, 1):
+        eprint("bounding", d, x, y, w, h)
+        # the digit ROI is thresholded on its own, the adaptive threshold depends on its borders
+        rois.append(gray_transform(gray_cropped_test_img[y:y + h, x:x + w]))
+        save_debug_img(rois[-1], img_basepath, f"07-{reference_category}-{cnt_counter}-digit-d{d}.png")
+    return (cropped_test_img, rects, rois)
+
+def read_display(image, box, img_basepath="frame", trace=NULL_TRACE):
+    """
+    Decodes the digits of the display box. Returns None if it does not look
+    like a valid reading.
+    """
+    (reference_category, cnt_counter) = (box.category, box.counter)
+    found = find_digit_rois(image, box, img_basepath, trace)
+    if found is None:
+        return None
+    (cropped_test_img, rects, rois) = found
+
+    classifier = template_classifier()
+    if classifier:
+        with trace.stage("classify"):
+            (digits, confidence) = classifier.classify(rois)
+        eprint("template digits", digits, "confidence", round(confidence, 3))
+        if trace.enabled:
+            trace.set("confidence", round(confidence, 3))
+        if confidence < TEMPLATE_MIN_CONFIDENCE:
+            return None
+        return int("".join(str(digit) for digit in digits))
+
+    thin = [w < box.digit_one_upper_length for (x, y, w, h) in rects]
+    with trace.stage("decode"):
+        (digits, boxes) = decode_digits(rois, thin, trace)
+    if DEBUG_DIR:
+        for (d, (x, y, w, h)) in enumerate(rects, 1):
+            for (i, (xA, yA, xB, yB)) in enumerate(boxes[d-1][:len(SEGMENT_NAMES)]):
+                save_debug_img(cropped_test_img[y:y + h, x:x + w], img_basepath, f"07-{reference_category}-{cnt_counter}-digit-d{d}-{i}.png",
+                               lambda acolor_roi, r=(int(xA), int(yA), int(xB), int(yB)): cv2.rectangle(acolor_roi, r[:2], r[2:], (0, 0, 255), 2))
+    if min(digits) < 0:
+        return None
+    result = "".join(str(digit) for digit in digits)
+    return int(result)
+
+
+def process_frame(test_img, img_basepath="frame", save_display_path=None, trace=NULL_TRACE):
+    """
+    OCR a frame that is already decoded in memory (BGR ndarray).
+    img_basepath names the debug directory, save_display_path is where the
+    cropped display box gets written to (if any).
+    """
+    if test_img is None:
+        return None
+    with trace.stage("resize"):
+        image = prepare_frame(test_img)
+    save_debug_img(image, img_basepath, "00-input.png")
+    return try_candidates(image, img_basepath, save_display_path, trace)[0]
+
+def save_display(image, box, path):
+    # the display box cropped out of the (already resized) frame
+    cropped = image[box.ty:box.by, box.lx:box.rx]
+    if cropped.size:
+        cv2.imwrite(path, cropped)
+
+def try_candidates(image, img_basepath="frame", save_display_path=None, trace=NULL_TRACE):
+    """
+    Tries the candidate display boxes in order, until one yields a reading.
+    Returns the value and the box (None, None if none of them did).
+    The display box of the reading (or of the last candidate, if none of
+    them yielded one) is written to save_display_path.
+    """
+    if THREADS > 0:
+        (result, box, last) = try_candidates_concurrently(image, img_basepath, trace)
+    else:
+        (result, box, last) = (None, None, None)
+        for last in display_box_candidates(image, img_basepath, trace):
+            result = attempt(image, last, img_basepath, trace)
+            if result is not None:
+                box = last
+                break
+    if save_display_path and last:
+        save_display(image, box or last, save_display_path)
+    return (result, box)
+
+_attempt_pool = None
+_attempt_pool_lock = threading.Lock()
+
+def attempt_pool():
+    # created on first use, frames may be processed on several threads
+    global _attempt_pool
+    with _attempt_pool_lock:
+        if _attempt_pool is None:
+            _attempt_pool = ThreadPoolExecutor(THREADS, thread_name_prefix="ocr-attempt")
+        return _attempt_pool
+
+def try_candidates_concurrently(image, img_basepath, trace):
+    """
+    Same as try_candidates, but the candidates of a pyramid level are all
+    tried at once on the attempt pool (OpenCV releases the GIL). The results
+    are still taken in the priority order, so the value is the same as the
+    sequential one; once it is known, the attempts that did not start yet
+    are cancelled and the running ones are ignored. The full resolution
+    search only runs if no candidate of PYRAMID_LEVEL succeeded.
+    Returns the value, its box and the last candidate that was waited for.
+    """
+    pool = attempt_pool()
+    cancelled = threading.Event()
+    tried = set()
+    last = None
+    try:
+        for level in sorted({PYRAMID_LEVEL, 0}, reverse=True):
+            boxes = [box for box in find_display_boxes(image, img_basepath, level, trace) if box[2:] not in tried]
+            tried.update(box[2:] for box in boxes)
+            # each attempt is traced on its own, the Trace is not thread safe
+            traces = [Trace(trace.name) if trace.enabled else NULL_TRACE for box in boxes]
+            futures = [pool.submit(attempt, image, box, img_basepath, t, cancelled)
+                       for (box, t) in zip(boxes, traces)]
+            for (last, t, future) in zip(boxes, traces, futures):
+                result = future.result()
+                trace.merge(t)
+                if result is not None:
+                    return (result, last, last)
+    finally:
+        cancelled.set()
+    return (None, None, last)
+
+def attempt(image, box, img_basepath, trace, cancelled=None):
+    if cancelled is not None and cancelled.is_set():
+        return None
+    trace.count("attempts")
+    with trace.stage("attempt:" + box.category):
+        result = read_display(image, box, img_basepath, trace)
+    if result is not None:
+        trace.set("category", box.category)
+    return result
+
+
+class OcrEngine:
+    """
+    Long-lived OCR state for a fixed camera. The display box that produced
+    the last valid reading is tried first; the full landmark search only runs
+    if that fails, and the cached box is dropped after max_misses misses in a row.
+    If no segment of the display changed since the last reading (see
+    display_signature), the previous value is returned without decoding it
+    again, at most max_hits times in a row.
+    If on_trace is set, every frame is traced and on_trace gets the record.
+    Frames may be processed on several threads at once: the state is only
+    accessed under the lock, each frame works on a snapshot of it.
+    """
+    def __init__(self, max_misses=3, on_trace=None, unchanged_threshold=UNCHANGED_THRESHOLD, max_hits=UNCHANGED_MAX_HITS):
+        self.max_misses = max_misses
+        self.on_trace = on_trace
+        self.unchanged_threshold = unchanged_threshold
+        self.max_hits = max_hits
+        self.cached_box = None
+        self.misses = 0
+        self.last = None # (box, segment layout, signature, value) of the last decoded display
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def process_frame(self, test_img, img_basepath="frame", save_display_path=None, trace=None):
+        if trace is None:
+            trace = Trace(img_basepath) if self.on_trace else NULL_TRACE
+        result = self._process_frame(test_img, img_basepath, save_display_path, trace)
+        if self.on_trace:
+            trace.set("value", result)
+            self.on_trace(trace.record())
+        return result
+
+    def _process_frame(self, test_img, img_basepath, save_display_path, trace):
+        if test_img is None:
+            return None
+        with self.lock:
+            (cached_box, last) = (self.cached_box, self.last)
+        if last and self.unchanged_threshold > 0:
+            with trace.stage("signature"):
+                result = self._unchanged(test_img, last, save_display_path)
+            if result is not None:
+                trace.set("unchanged", True)
+                trace.set("category", "unchanged")
+                return result
+        with trace.stage("resize"):
+            image = prepare_frame(test_img)
+        save_debug_img(image, img_basepath, "00-input.png")
+        if cached_box:
+            result = attempt(image, cached_box._replace(category="cached"), img_basepath, trace)
+            if save_display_path:
+                # replaced below by try_candidates on a miss, if it finds any candidate
+                save_display(image, cached_box, save_display_path)
+            if result is not None:
+                self._remember(test_img, image, cached_box, result)
+                return result
+            trace.count("cache_misses")
+            with self.lock:
+                self.misses += 1
+                eprint("cached display box missed", self.misses)
+                # another thread may have replaced it meanwhile
+                if self.misses >= self.max_misses and self.cached_box == cached_box:
+                    self.cached_box = None
+        (result, box) = try_candidates(image, img_basepath, save_display_path, trace)
+        if result is not None:
+            self._remember(test_img, image, box, result)
+        return result
+
+    def _unchanged(self, test_img, last, save_display_path):
+        (box, layout, signature, value) = last
+        current = display_signature(test_img, box, layout)
+        if current is None:
+            return None
+        diff = float(np.abs(current - signature).max())
+        with self.lock:
+            if self.last is not last or self.hits >= self.max_hits or diff >= self.unchanged_threshold:
+                return None
+            self.hits += 1
+        eprint("display unchanged", round(diff, 3), "returning", value)
+        if save_display_path:
+            save_display(prepare_frame(test_img), box, save_display_path)
+        return value
+
+    def _remember(self, test_img, image, box, value):
+        # the box produced the value, it is the cached one from now on
+        last = None
+        if self.unchanged_threshold > 0:
+            layout = segment_layout(image, box)
+            signature = display_signature(test_img, box, layout) if layout is not None else None
+            if signature is not None:
+                last = (box, layout, signature, value)
+        with self.lock:
+            self.cached_box = box
+            self.misses = 0
+            self.last = last
+            self.hits = 0
+
+    def process_img(self, img_path, trace=None):
+        if trace is None:
+            trace = Trace(os.path.basename(img_path)) if self.on_trace else NULL_TRACE
+        with trace.stage("load"):
+            test_img = cv2.imread(img_path)
+        return self.process_frame(test_img, os.path.basename(img_path), os.getenv("SAVE_DISPLAY_PATH"), trace)
 
 
 def do_the_job(*imgs):
@@ -487,7 +1055,65 @@ def do_the_job(*imgs):
         eprint("-----------", img)
         re.append(process_img(img))
     return re
-    
+
+def vote(values):
+    """
+    Majority vote per digit over the readings of several frames (None for
+    failed ones). Returns the value and the confidence: the share of all the
+    frames that agree with the weakest digit of it.
+    """
+    readings = [str(v) for v in values if v is not None]
+    if not readings:
+        return (None, 0.0)
+    length = Counter(len(r) for r in readings).most_common(1)[0][0]
+    readings = [r for r in readings if len(r) == length]
+    result = ""
+    confidence = 1.0
+    for i in range(length):
+        (digit, count) = Counter(r[i] for r in readings).most_common(1)[0]
+        result += digit
+        confidence = min(confidence, count / len(values))
+    return (int(result), confidence)
+
+def process_img_timed(img):
+    start = time.monotonic()
+    value = process_img(img)
+    elapsed_ms = round((time.monotonic() - start) * 1000, 1)
+    if debug_writer:
+        # the pool workers exit without running the atexit handlers
+        debug_writer.flush()
+    return {"path": img, "value": value, "elapsed_ms": elapsed_ms}
+
+def init_batch_worker():
+    # the parallelism comes from the pool, opencv's own threads would just compete with it
+    cv2.setNumThreads(1)
+
+def do_the_batch(imgs, jobs=None, ordered=False):
+    """
+    Fans the images out over a process pool, yields a result dict per image
+    as soon as it is done (or in input order, if ordered).
+    """
+    with multiprocessing.Pool(jobs or os.cpu_count(), initializer=init_batch_worker) as pool:
+        mapper = pool.imap if ordered else pool.imap_unordered
+        for r in mapper(process_img_timed, imgs):
+            yield r
+
 if __name__ == "__main__":
-    x = do_the_job(*sys.argv[1:])
-    print(json.dumps(x))
+    parser = argparse.ArgumentParser(description="Reads the temperature from pictures of the display of the heater")
+    parser.add_argument("--batch", action="store_true", help="process the images in parallel and print a JSON line (path, value, elapsed_ms) per image as they finish")
+    parser.add_argument("-j", "--jobs", type=int, help="number of worker processes in batch mode (default: number of cores)")
+    parser.add_argument("--ordered", action="store_true", help="keep the input order in batch mode")
+    parser.add_argument("--build-templates", metavar="EXPECTED_JSON", help="build the template bank of OCR_CLASSIFIER=template (written to OCR_TEMPLATES) from the images and their expected values")
+    parser.add_argument("imgs", nargs="*")
+    args = parser.parse_args()
+    if args.build_templates:
+        with open(args.build_templates) as f:
+            classifier = build_templates(args.imgs, json.load(f))
+        classifier.save(TEMPLATES_PATH)
+        eprint("saved", len(classifier.labels), "templates to", TEMPLATES_PATH)
+    elif args.batch:
+        for r in do_the_batch(args.imgs, args.jobs, args.ordered):
+            print(json.dumps(r), flush=True)
+    else:
+        x = do_the_job(*args.imgs)
+        print(json.dumps(x))
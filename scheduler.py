@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+# Runs the periodic jobs of the server (cron expressions, intervals and one
+# shot delays) from a single thread sleeping until the next fire time of a
+# heap, on a bounded worker pool. A job never runs concurrently with itself.
+
+import sys
+import time
+import heapq
+import itertools
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import pycron
+
+# what to do with a run that could not happen at its time (the job was still
+# running, or the scheduler was late, e.g. after a suspend or a clock change)
+CATCHUP_SKIP = "skip" # drop it, wait for the next one
+CATCHUP_ONCE = "once" # run it as soon as possible, the missed runs coalesced into one
+
+MISFIRE_GRACE = 60 # seconds a run may be late before it counts as missed
+MAX_SLEEP = 300    # wake up at least this often, the wall clock may have been changed
+
+def eprint(*args, **kwargs):
+    print(*args, **kwargs, file=sys.stderr)
+
+def cron_next(expr, after, horizon_days=5 * 366):
+    """
+    The timestamp of the first minute after the timestamp matching the cron
+    expression (in local time), None if there is none within horizon_days.
+    """
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError(f"invalid cron expression: {expr!r}")
+    # whole days and hours are skipped when they can not match
+    day_expr = "* * " + " ".join(fields[2:])
+    hour_expr = "* " + " ".join(fields[1:])
+    dt = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = dt + timedelta(days=horizon_days)
+    while dt < limit:
+        if not pycron.is_now(day_expr, dt):
+            dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+        elif not pycron.is_now(hour_expr, dt):
+            dt = dt.replace(minute=0) + timedelta(hours=1)
+        elif pycron.is_now(expr, dt):
+            return dt.timestamp()
+        else:
+            dt += timedelta(minutes=1)
+    return None
+
+class Job:
+    def __init__(self, name, func, rule, catchup, description):
+        self.name = name
+        self.func = func
+        self.rule = rule # the fire time after a fire time, None if it does not repeat
+        self.catchup = catchup
+        self.description = description
+        self.next = None # the next fire time, None if not scheduled
+        self.seq = None  # of the valid heap entry of the job
+        self.running = False
+        self.pending = False
+        self.last_start = None
+        self.last_duration = None
+        self.last_error = None
+        self.runs = 0
+        self.missed = 0
+
+    def snapshot(self):
+        return {
+            "name": self.name,
+            "schedule": self.description,
+            "next": self.next,
+            "running": self.running,
+            "last_start": self.last_start,
+            "last_duration": self.last_duration,
+            "last_error": self.last_error,
+            "runs": self.runs,
+            "missed": self.missed,
+            "catchup": self.catchup,
+        }
+
+class Scheduler:
+    def __init__(self, workers=4, on_run=None):
+        self.on_run = on_run # called with the name, start time, duration and error (None if it succeeded) of the runs
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="job")
+        self.cond = threading.Condition()
+        self.heap = [] # (fire time, seq, job)
+        self.seqs = itertools.count()
+        self.jobs = {}
+        self.thread = None
+        self.stopped = False
+
+    def cron(self, name, expr, func, catchup=CATCHUP_SKIP):
+        """
+        Runs func at the minutes matching the cron expression.
+        """
+        rule = lambda after: cron_next(expr, after)
+        self._add(name, func, rule, rule(time.time()), catchup, f"cron {expr}")
+
+    def every(self, name, seconds, func, delay=0, catchup=CATCHUP_SKIP):
+        """
+        Runs func every seconds, first after delay seconds.
+        """
+        self._add(name, func, lambda after: after + seconds, time.time() + delay, catchup, f"every {seconds}s")
+
+    def call_later(self, name, delay, func):
+        """
+        Runs func once, after delay seconds. It replaces the next run of
+        the job of the same name, so a job can reschedule itself.
+        """
+        self._add(name, func, lambda after: None, time.time() + delay, CATCHUP_ONCE, "once")
+
+    def has(self, name):
+        """
+        Whether the job is scheduled or running.
+        """
+        with self.cond:
+            return name in self.jobs
+
+    def cancel(self, name):
+        with self.cond:
+            job = self.jobs.get(name)
+            if not job:
+                return
+            job.next = job.seq = None
+            job.pending = False
+            if not job.running:
+                del self.jobs[name]
+
+    def schedule(self):
+        """
+        The state of the jobs, the next to fire first.
+        """
+        with self.cond:
+            jobs = sorted(self.jobs.values(), key=lambda j: (j.next is None, j.next or 0, j.name))
+            return [j.snapshot() for j in jobs]
+
+    def _add(self, name, func, rule, first, catchup, description):
+        with self.cond:
+            job = self.jobs.get(name)
+            if job:
+                (job.func, job.rule, job.catchup, job.description) = (func, rule, catchup, description)
+            else:
+                job = self.jobs[name] = Job(name, func, rule, catchup, description)
+            self._push(job, first)
+
+    def _push(self, job, t):
+        job.next = t
+        job.seq = None
+        if t is None:
+            return
+        job.seq = next(self.seqs)
+        heapq.heappush(self.heap, (t, job.seq, job))
+        self.cond.notify()
+
+    def _submit(self, job):
+        job.running = True
+        self.executor.submit(self._run_job, job)
+
+    def _run_job(self, job):
+        start = time.time()
+        error = None
+        try:
+            job.func()
+        except Exception as e:
+            eprint("job failed:", job.name, repr(e))
+            error = repr(e)
+        duration = time.time() - start
+        if self.on_run:
+            self.on_run(job.name, start, duration, error)
+        with self.cond:
+            job.running = False
+            (job.last_start, job.last_duration, job.last_error) = (start, duration, error)
+            job.runs += 1
+            if job.pending:
+                job.pending = False
+                self._submit(job)
+            elif job.next is None and self.jobs.get(job.name) is job:
+                del self.jobs[job.name]
+
+    def _fire(self, job, t, now):
+        late = now - t > MISFIRE_GRACE
+        if job.running or late:
+            job.missed += 1
+            if job.catchup == CATCHUP_ONCE:
+                if job.running:
+                    job.pending = True
+                else:
+                    self._submit(job)
+        else:
+            self._submit(job)
+        t = job.rule(t)
+        if t is not None and t <= now:
+            # the runs in the past are not made up for one by one
+            t = job.rule(now)
+        self._push(job, t)
+        if t is None and not job.running and not job.pending:
+            del self.jobs[job.name]
+
+    def _loop(self):
+        with self.cond:
+            while not self.stopped:
+                now = time.time()
+                if not self.heap:
+                    self.cond.wait(MAX_SLEEP)
+                    continue
+                (t, seq, job) = self.heap[0]
+                if job.seq != seq:
+                    # rescheduled or cancelled
+                    heapq.heappop(self.heap)
+                    continue
+                if t > now:
+                    self.cond.wait(min(t - now, MAX_SLEEP))
+                    continue
+                heapq.heappop(self.heap)
+                self._fire(job, t, now)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.executor.shutdown(wait=False)
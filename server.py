@@ -16,19 +16,48 @@ import json
 import subprocess
 import threading
 import glob
-import sqlite3
-import pycron
+import shutil
 import signal
 from datetime import datetime
+from collections import defaultdict, Counter
+import io
+import asyncio
+import cv2
+import numpy as np
+from urllib.parse import urlsplit, parse_qs
+from email.utils import formatdate, parsedate_to_datetime
+import ocr
+from concurrent.futures import ThreadPoolExecutor
+from grabber import FrameGrabber, ffmpeg_keyframes_cmd, decode_bmp, read_bmp_frames
+from db import Database
+from static import StaticCache
+from aserver import AsyncHTTPServer
+from events import Broadcaster
+from metrics import Registry
+from scheduler import Scheduler, CATCHUP_ONCE
 
+CAMURL=os.getenv("CAMURL")
 LIVE_STREAM_URL=os.getenv("LIVE_STREAM_URL")
 LISTEN_PORT=int(os.getenv("LISTEN_PORT") or "80")
+SERVER_MODE=os.getenv("SERVER_MODE") or "threading" # or asyncio
+HTTP_WORKERS=int(os.getenv("HTTP_WORKERS") or "16")
+HTTP_TIMEOUT=int(os.getenv("HTTP_TIMEOUT") or "30")
+EVENTS_MAX_CLIENTS=int(os.getenv("EVENTS_MAX_CLIENTS") or "8")
+EVENTS_QUEUE=int(os.getenv("EVENTS_QUEUE") or "100")
+EVENTS_KEEPALIVE=int(os.getenv("EVENTS_KEEPALIVE") or "15")
 DATADIR=os.getenv("DATADIR") or "/tmp"
 DB_PATH=os.getenv("DB_PATH") or os.path.join(DATADIR,"water.db")
+DB_READERS=int(os.getenv("DB_READERS") or "4")
+RANGE_POINTS=int(os.getenv("RANGE_POINTS") or "1000")
+RANGE_MAX_POINTS=int(os.getenv("RANGE_MAX_POINTS") or "10000")
+STATIC_CACHE_MAX_FILE=int(os.getenv("STATIC_CACHE_MAX_FILE") or str(256 * 1024))
+STATIC_CACHE_MAX_TOTAL=int(os.getenv("STATIC_CACHE_MAX_TOTAL") or str(16 * 1024 * 1024))
 STATICDIR=os.getenv("STATICDIR") or os.path.dirname(__file__)
 
 CLEAN_OLDER_THAN_DAYS=int(os.getenv("CLEAN_OLDER_THAN_DAYS") or "30")
 CLEAN_SLEEP=int(os.getenv("CLEAN_SLEEP") or "86400")
+SCHEDULER_WORKERS=int(os.getenv("SCHEDULER_WORKERS") or "4")
+ENERGY_QUERY_CRON=os.getenv("ENERGY_QUERY_CRON") or "0 * * * *"
 
 PERIODIC_QUERY_CRON=os.getenv("PERIODIC_QUERY_CRON") or "0 6-23 * * *" # https://github.com/kipe/pycron https://stackoverflow.com/questions/373335/how-do-i-get-a-cron-like-scheduler-in-python
 
@@ -38,96 +67,293 @@ if MODE_333:
 
 PERIODIC_ONLY_WHEN_UNUSED=int(os.getenv("PERIODIC_ONLY_WHEN_UNUSED") or "0")
 PERIODIC_FOLLOWUP_SLEEP=int(os.getenv("PERIODIC_FOLLOWUP_SLEEP") or "300")
+# the follow up interval adapts between these (see followup_interval), they are the same by default
+FOLLOWUP_MIN_SLEEP=int(os.getenv("FOLLOWUP_MIN_SLEEP") or str(PERIODIC_FOLLOWUP_SLEEP))
+FOLLOWUP_MAX_SLEEP=int(os.getenv("FOLLOWUP_MAX_SLEEP") or str(PERIODIC_FOLLOWUP_SLEEP))
+FOLLOWUP_BACKOFF=float(os.getenv("FOLLOWUP_BACKOFF") or "2")
+FOLLOWUP_SLOPE_WINDOW=int(os.getenv("FOLLOWUP_SLOPE_WINDOW") or "1800")
+FOLLOWUP_STABLE_SLOPE=float(os.getenv("FOLLOWUP_STABLE_SLOPE") or "1") # degrees per hour
+TAPO_POWER_THRESHOLD=int(os.getenv("TAPO_POWER_THRESHOLD") or "1200") # same as in tapo-plug.py
+
+PERSISTENT_GRABBER=int(os.getenv("PERSISTENT_GRABBER") or "0")
+GRABBER_FRAMES=int(os.getenv("GRABBER_FRAMES") or "5")
+GRABBER_MAX_AGE=int(os.getenv("GRABBER_MAX_AGE") or "30")
+GRABBER_WAIT=int(os.getenv("GRABBER_WAIT") or "20")
+
+CONSENSUS_FRAMES=int(os.getenv("CONSENSUS_FRAMES") or "1")
+CONSENSUS_MIN_CONFIDENCE=float(os.getenv("CONSENSUS_MIN_CONFIDENCE") or "0.5")
+OCR_BOX_MAX_MISSES=int(os.getenv("OCR_BOX_MAX_MISSES") or "3")
 
 TEMPORARY_DISPLAYBOX = (os.getenv("TEMPORARY_DISPLAYBOX") or "0") == "1"
 TAPOPLUG_IP=os.environ["TAPOPLUG_IP"]
 
-GETDIGITS_PATH = os.path.join(os.path.dirname(__file__),"getdigits.sh")
 TAPOPLUG_PATH = os.path.join(os.path.dirname(__file__),"tapo-plug.py")
 static_extensions = {
     ".html": "text/html",
     ".js": "application/javascript",
 }
+# the routes of the server, see StreamServer.route
+ROUTES = ["/", "/live", "/fetch", "/events", "/range", "/metadata", "/latest", "/ocrstats", "/metrics", "/schedule", "/temperature"]
 
 tlock = threading.Lock()
 
-followup_thread = None
+grabber = None
+database = None
+followup_sleep = FOLLOWUP_MIN_SLEEP # the current interval of the follow up queries
+# revision of the last committed write to temperature or energy_data (see next_rev) and its time
+data_rev = 0
+data_modified = int(time.time())
+# the last revision handed out, ahead of data_rev until its write is committed
+last_rev = 0
+
+def next_rev():
+    # only call it inside database.write(), that serializes the writers, and
+    # publish_rev() it once committed: /fetch must not claim a rev its reads can not see yet
+    global last_rev
+    last_rev += 1
+    return last_rev
+
+def publish_rev(rev):
+    global data_rev, data_modified
+    data_rev = max(data_rev, rev)
+    data_modified = int(time.time())
+
+class OcrStats:
+    """
+    Aggregates the ocr.Trace records of the processed frames, so it is
+    visible which stage dominates on the camera of this instance.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.failures = 0
+        self.stages = defaultdict(lambda: [0, 0.0, 0.0]) # count, sum, max
+        self.counts = Counter()
+        self.categories = Counter()
+        self.last = None
+
+    def add(self, record):
+        with self.lock:
+            self.frames += 1
+            if record.get("value") is None:
+                self.failures += 1
+            for (name, elapsed) in record["stages"].items():
+                ocr_stage_seconds.labels(name).observe(elapsed)
+                s = self.stages[name]
+                s[0] += 1
+                s[1] += elapsed
+                s[2] = max(s[2], elapsed)
+            self.counts.update(record["counts"])
+            self.categories[str(record.get("category"))] += 1
+            self.last = record
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "frames": self.frames,
+                "failures": self.failures,
+                "stages_ms": {k: {"count": c, "avg": round(t / c * 1000, 3), "max": round(m * 1000, 3)} for (k, (c, t, m)) in self.stages.items()},
+                "counts": dict(self.counts),
+                "categories": dict(self.categories),
+                "last": self.last,
+            }
+
+registry = Registry()
+capture_seconds = registry.histogram("water_capture_seconds", "Time to capture the frames of a reading.", ["source"])
+capture_failures = registry.counter("water_capture_failures_total", "Captures that returned no frame.", ["source"])
+ocr_seconds = registry.histogram("water_ocr_seconds", "Time to OCR the frames of a reading.")
+ocr_results = registry.counter("water_ocr_total", "OCR runs of the readings by result (ok, failed, error).", ["result"])
+ocr_stage_seconds = registry.histogram("water_ocr_stage_seconds", "Time of the OCR stages of a frame.", ["stage"],
+                                       (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+heater_restarts = registry.counter("water_heater_restarts_total", "Restarts of the heater by result.", ["result"])
+plug_seconds = registry.histogram("water_plug_seconds", "Duration of the tapo-plug.py runs.", ["command"])
+db_write_seconds = registry.histogram("water_db_write_seconds", "Duration of the database writes, waiting for the writer included.", ["op"])
+job_last_run = registry.gauge("water_job_last_run_timestamp_seconds", "Last time the scheduled job started.", ["job"])
+job_seconds = registry.histogram("water_job_seconds", "Duration of the runs of the scheduled jobs.", ["job"])
+job_errors = registry.counter("water_job_errors_total", "Runs of the scheduled jobs that raised.", ["job"])
+scheduler_alive = registry.gauge("water_scheduler_alive", "1 if the scheduler thread is running.")
+followup_sleep_gauge = registry.gauge("water_followup_interval_seconds", "Current interval of the follow up queries.")
+http_requests = registry.counter("water_http_requests_total", "HTTP requests by route and status code.", ["method", "route", "code"])
+db_rows = registry.gauge("water_db_rows", "Number of the rows of the tables.", ["table"])
+
+def job_ran(name, start, duration, error):
+    job_last_run.labels(name).set(start)
+    job_seconds.labels(name).observe(duration)
+    if error:
+        job_errors.labels(name).inc()
+
+def count_rows(table):
+    with database.read() as db:
+        return db.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+
+for table in ["temperature", "energy_data", "temperature_hourly", "temperature_daily", "energy_daily"]:
+    db_rows.labels(table).set_function(lambda table=table: count_rows(table))
+
+scheduler = Scheduler(SCHEDULER_WORKERS, job_ran)
+followup_sleep_gauge.set_function(lambda: followup_sleep)
+scheduler_alive.set_function(lambda: int(scheduler.thread is not None and scheduler.thread.is_alive()))
+
+ocr_stats = OcrStats()
+static_cache = StaticCache(STATIC_CACHE_MAX_FILE, STATIC_CACHE_MAX_TOTAL)
+events = Broadcaster(EVENTS_QUEUE, EVENTS_MAX_CLIENTS)
+ocr_engine = ocr.OcrEngine(OCR_BOX_MAX_MISSES, ocr_stats.add)
+ocr_pool = ThreadPoolExecutor(max_workers=CONSENSUS_FRAMES) if CONSENSUS_FRAMES > 1 else None
 
 def eprint(*args, **kwargs):
     today = datetime.now()
     iso_date = today.isoformat()
     print("["+iso_date+"]", *args, **kwargs, file=sys.stderr)
 
-def cleanup_thread():
+def cleanup_job():
     p = os.path.join(DATADIR, "water-*.png")
-    while True:
-        eprint("Running datadir cleanup")
-        now = int(time.time())
-        for f in glob.glob(p):
-            try:
-                s = os.stat(f)
-                age_seconds = now - s.st_mtime
-                age_days = age_seconds / 86400
-                if age_days >= CLEAN_OLDER_THAN_DAYS:
-                    eprint("Removing", f)
-                    os.unlink(f)
-            except:
-                pass
-        time.sleep(CLEAN_SLEEP)
-        
-def followup_logic():
-    global followup_thread
-    eprint("New follow up thread started")
-    while True:
-        time.sleep(PERIODIC_FOLLOWUP_SLEEP)
-        r = (None,)
+    eprint("Running datadir cleanup")
+    now = int(time.time())
+    for f in glob.glob(p):
         try:
-            eprint("Followup query attempt...")
-            r = query_temperature()
+            s = os.stat(f)
+            age_seconds = now - s.st_mtime
+            age_days = age_seconds / 86400
+            if age_days >= CLEAN_OLDER_THAN_DAYS:
+                eprint("Removing", f)
+                os.unlink(f)
         except:
             pass
-        if not r[0]:
-            # it was unsuccessful, time to terminate
-            eprint("Follow up thread did not manage to query the temperature, terminating")
-            followup_thread = None
-            break
-
-def _query_temperature_locked(restart_is_fine = False, callback = None, save_pix = False):
-    global followup_thread
+
+def temperature_slope(window):
+    """
+    The trend of the readings of the last window seconds in degrees per
+    hour (least squares), None if there are not enough of them.
+    """
+    with database.read() as db:
+        rows = db.execute("SELECT ts, temp FROM temperature WHERE ts > ?", (int(time.time()) - window,)).fetchall()
+    if len({ts for (ts, _) in rows}) < 2:
+        return None
+    (ts, temps) = np.array(rows, dtype=float).T
+    return np.polyfit((ts - ts[0]) / 3600, temps, 1)[0]
+
+def plug_power():
+    # the current power draw of the heater as reported by the plug, None if it could not be read
+    try:
+        with plug_seconds.labels("power").time():
+            p = subprocess.run([TAPOPLUG_PATH, TAPOPLUG_IP], stdout=subprocess.PIPE, timeout=30)
+        if p.returncode == 0:
+            return json.loads(p.stdout)["energy_usage"]["current_power"]
+    except Exception as e:
+        eprint("error while retrieving the power draw", e)
+    return None
+
+def followup_interval(previous):
+    """
+    The time until the next follow up query: short while the temperature
+    is changing (about a reading per degree) or the heater is drawing power,
+    backing off exponentially from the previous one while it is stable.
+    """
+    if FOLLOWUP_MIN_SLEEP >= FOLLOWUP_MAX_SLEEP:
+        return FOLLOWUP_MIN_SLEEP
+    slope = temperature_slope(FOLLOWUP_SLOPE_WINDOW)
+    power = plug_power()
+    if power is not None and power >= TAPO_POWER_THRESHOLD:
+        interval = FOLLOWUP_MIN_SLEEP
+    elif slope is not None and abs(slope) >= FOLLOWUP_STABLE_SLOPE:
+        interval = 3600 / abs(slope)
+    else:
+        interval = previous * FOLLOWUP_BACKOFF
+    interval = int(min(max(interval, FOLLOWUP_MIN_SLEEP), FOLLOWUP_MAX_SLEEP))
+    eprint("Next follow up query in", interval, "seconds, slope:", slope, "power:", power)
+    return interval
+
+def followup_job():
+    global followup_sleep
+    r = (None,)
+    try:
+        eprint("Followup query attempt...")
+        r = query_temperature()
+    except:
+        pass
+    if not r[0]:
+        # it was unsuccessful, time to terminate
+        eprint("Follow up query did not manage to read the temperature, not rescheduling it")
+        return
+    followup_sleep = followup_interval(followup_sleep)
+    scheduler.call_later("followup", followup_sleep, followup_job)
+
+def capture_frames(n, newer_than=0):
+    if grabber:
+        return [f[1] for f in grabber.recent(n, max(newer_than, time.time() - GRABBER_MAX_AGE), GRABBER_WAIT)]
+    # same as getdigits.sh, but the keyframes are piped back as BMP and decoded in memory
+    try:
+        p = subprocess.run(ffmpeg_keyframes_cmd(CAMURL, n), stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL, start_new_session=True)
+    except (OSError, TypeError) as e:
+        # ffmpeg is missing or CAMURL is not set, same as a failed capture
+        eprint("Failed to run ffmpeg", e)
+        return []
+    if p.returncode != 0 or not p.stdout:
+        return []
+    frames = [decode_bmp(data) for data in read_bmp_frames(io.BytesIO(p.stdout))]
+    return [f for f in frames if f is not None]
+
+def ocr_frames(frames, name, save_display_path, acallback):
+    # the value (None if it is not reliable) and whether any of the frames could be read
+    if len(frames) == 1:
+        result = ocr_engine.process_frame(frames[0], name, save_display_path)
+        return (result, result is not None)
+    # OpenCV releases the GIL, the frames can be processed in parallel
+    names = [name] + [f"{name}-{i}" for i in range(1, len(frames))]
+    paths = [save_display_path] + [None] * (len(frames) - 1)
+    values = list(ocr_pool.map(ocr_engine.process_frame, frames, names, paths))
+    (result, confidence) = ocr.vote(values)
+    acallback(f"Consensus of {len(frames)} frames: {result} (confidence: {confidence:.2f})")
+    read = any(v is not None for v in values)
+    if confidence < CONSENSUS_MIN_CONFIDENCE:
+        eprint("Consensus is too weak", values)
+        return (None, read)
+    return (result, read)
+
+def _query_temperature_locked(restart_is_fine = False, callback = None, save_pix = False, newer_than = 0):
+    global followup_sleep
     def acallback(msg):
         eprint(msg)
+        events.publish("progress", msg)
         if not callback: return
         callback(msg)
 
     eprint("_query_temperature_locked", restart_is_fine, callback is None, save_pix)
     result = None
+    read = False # any of the frames, the heater is only restarted if none of them could be read
     now = int(time.time())
     b_full_picture = f"water-full-{now}.png"
     full_picture = os.path.join(DATADIR, b_full_picture)
     b_display_box = f"water-display-{now}.png"
     display_box = os.path.join(DATADIR, b_display_box)
 
-    env = {**os.environ}
-    if save_pix:
-        env["SAVE_DISPLAY_PATH"] = display_box
-    acallback("Running getdigits")
-    eprint(GETDIGITS_PATH, full_picture)
-    p = subprocess.Popen([GETDIGITS_PATH, full_picture], env=env, stdout=subprocess.PIPE, start_new_session=True)
-    try:
-        (p_stdout, p_stderr) = p.communicate()
-    except:
-        p.returncode = 143 # timeout
-    if not save_pix:
-        os.unlink(full_picture)
-    
-    if p.returncode == 0:
-        result = json.loads(p_stdout)[0]
-        if result and not MODE_333 and not followup_thread:
-            # time to kick off a follow up thread
-            followup_thread = threading.Thread(target=followup_logic, args=())
-            followup_thread.start()
-
-    if p.returncode != 0:
+    acallback("Capturing the display")
+    source = "grabber" if grabber else "ffmpeg"
+    with capture_seconds.labels(source).time():
+        frames = capture_frames(CONSENSUS_FRAMES, newer_than)
+    ok = len(frames) > 0
+    if not ok:
+        capture_failures.labels(source).inc()
+    if ok:
+        if save_pix:
+            cv2.imwrite(full_picture, frames[0])
+        acallback("Running OCR")
+        try:
+            with ocr_seconds.time():
+                (result, read) = ocr_frames(frames, b_full_picture, display_box if save_pix else None, acallback)
+            ocr_results.labels("ok" if result else "failed").inc()
+        except Exception as e:
+            eprint("OCR failed", e)
+            ocr_results.labels("error").inc()
+            ok = False
+
+    if ok and result and not MODE_333 and not scheduler.has("followup"):
+        # time to kick off the follow up queries
+        eprint("Scheduling follow up queries")
+        followup_sleep = FOLLOWUP_MIN_SLEEP
+        scheduler.call_later("followup", followup_sleep, followup_job)
+
+    if not ok:
         acallback("Error running the command...")
     elif not result:
         acallback("Failed reading the digits...")
@@ -135,19 +361,22 @@ def _query_temperature_locked(restart_is_fine = False, callback = None, save_pix
     if save_pix:
         acallback("image: "+b_display_box)
 
-    if (p.returncode != 0 or not result) and restart_is_fine:
+    # a callable is only asked if the heater needs a restart, see Flight
+    if (not ok or not read) and (restart_is_fine() if callable(restart_is_fine) else restart_is_fine):
         acallback("Restarting the heater...")
         myenv = dict(os.environ)
         if restart_is_fine == "unused":
             myenv["TAPO_ONLY_WHEN_UNUSED"] = "1"
-        p = subprocess.run([TAPOPLUG_PATH, TAPOPLUG_IP, "off", "on"], env=myenv)
+        with plug_seconds.labels("restart").time():
+            p = subprocess.run([TAPOPLUG_PATH, TAPOPLUG_IP, "off", "on"], env=myenv)
+        heater_restarts.labels("ok" if p.returncode == 0 else "failed").inc()
         if p.returncode != 0:
             acallback("Failed to restart the heater...")
             return (result, b_full_picture, b_display_box, now)
         acallback("Heater restarted...")
         # Waiting a few seconds as it displays 88 at start
         time.sleep(3)
-        return _query_temperature_locked(False, callback, save_pix)
+        return _query_temperature_locked(False, callback, save_pix, time.time())
 
     if MODE_333 and result == 33:
         eprint("display shows 33, ignoring")
@@ -173,48 +402,212 @@ def query_temperature(restart_is_fine = False, callback = None, save_pix = False
     if temp:
         now = r[3]
         eprint("Persisting result", now, temp)
-        db = get_db()
-        cur = db.cursor()
-        temps = list(db.execute("SELECT temp, ts FROM temperature WHERE ts > strftime('%s', datetime('now', '-1 Hour')) ORDER BY ts DESC LIMIT 2"))
-        if len(temps) == 2 and temps[0][0] == temps[1][0] and temp == temps[0][0]:
-           eprint("Shifting the most recent temperature value in the db", now, temps[0][1], temp)
-           # we can shift the most recent one
-           cur.execute("UPDATE temperature SET ts=? WHERE ts=?", (now, temps[0][1]))
-        else:
-           eprint("Persisting a new temperature entry in the dba, now, temp")
-           cur.execute("INSERT INTO temperature (ts, temp) VALUES(?,?)", (now, temp))
-        db.commit()
+        with db_write_seconds.labels("temperature").time(), database.write() as db:
+            temps = list(db.execute("SELECT temp, ts, rowid FROM temperature WHERE ts > ? ORDER BY ts DESC LIMIT 2", (int(time.time()) - 3600,)))
+            if len(temps) == 2 and temps[0][0] == temps[1][0] and temp == temps[0][0]:
+               eprint("Shifting the most recent temperature value in the db", now, temps[0][1], temp)
+               # we can shift the most recent one
+               rev = next_rev()
+               db.execute("UPDATE temperature SET ts=?, rev=? WHERE ts=?", (now, rev, temps[0][1]))
+               update_temperature_rollups(db, [temps[0][1], now])
+               rowid = temps[0][2]
+            else:
+               eprint("Persisting a new temperature entry in the dba, now, temp")
+               rev = next_rev()
+               rowid = db.execute("INSERT INTO temperature (ts, temp, rev) VALUES(?,?,?)", (now, temp, rev)).lastrowid
+               update_temperature_rollups(db, [now])
+        publish_rev(rev)
+        # same as the points of /fetch
+        events.publish("temperature", {"x": now * 1000, "y": temp, "id": rowid, "rev": rev})
     return r
 
 
+def update_temperature_rollups(db, timestamps):
+    """
+    Recomputes the hourly and daily temperature rollups of the hours of
+    the given timestamps, after the readings of them changed. Call it in
+    the write transaction of the change.
+    """
+    hours = {ts // 3600 * 3600 for ts in timestamps}
+    for h in hours:
+        db.execute("DELETE FROM temperature_hourly WHERE ts=?", (h,))
+        db.execute("INSERT INTO temperature_hourly SELECT ?, min(temp), max(temp), sum(temp), count(*) FROM temperature "
+                   "WHERE ts >= ? AND ts < ? HAVING count(*) > 0", (h, h, h + 3600))
+    for (day, next_day) in {db.execute(f"SELECT {day_sql('?')}, {day_sql('?', 1)}", (h, h)).fetchone() for h in hours}:
+        db.execute("DELETE FROM temperature_daily WHERE ts=?", (day,))
+        db.execute("INSERT INTO temperature_daily SELECT ?, min(min), max(max), sum(sum), sum(count) FROM temperature_hourly "
+                   "WHERE ts >= ? AND ts < ? HAVING count(*) > 0", (day, day, next_day))
+
+def update_energy_rollups(db, ts_from, ts_to):
+    """
+    Recomputes the daily energy rollups of the days between the timestamps,
+    in the write transaction that changed energy_data.
+    """
+    db.execute(f"INSERT OR REPLACE INTO energy_daily SELECT {day_sql('ts_start')}, sum(usage) FROM energy_data "
+               f"WHERE ts_start >= {day_sql('?')} AND ts_start < {day_sql('?', 1)} GROUP BY 1", (ts_from, ts_to))
+
+def lttb(xs, ys, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling: keeps threshold points of
+    the series (the first, the last and one per bucket in between, the one
+    forming the largest triangle with its neighbours), so the shape of it
+    is preserved. Returns the indexes of the kept points.
+    """
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(xs, dtype=np.float64)
+    y = np.asarray(ys, dtype=np.float64)
+    edges = np.floor(np.linspace(1, n - 1, threshold - 1)).astype(int)
+    kept = np.zeros(threshold, dtype=int)
+    a = 0
+    for i in range(threshold - 2):
+        (start, end) = (edges[i], edges[i + 1])
+        # the average point of the next bucket (the last point for the last bucket)
+        (nstart, nend) = (end, edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        (cx, cy) = (x[nstart:nend].mean(), y[nstart:nend].mean())
+        area = np.abs((x[a] - cx) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (cy - y[a]))
+        a = start + int(area.argmax())
+        kept[i + 1] = a
+    kept[-1] = n - 1
+    return kept
+
+class Flight:
+    """
+    A temperature query (with save_pix) run on behalf of all the POST
+    /temperature requests that arrive while it is in progress: each of them
+    gets all its progress messages (the ones before it joined are replayed)
+    and the same result. A forced request upgrades the query in flight, if
+    it did not decide yet whether to restart the heater.
+    """
+    lock = threading.Lock()
+    current = None
+
+    def __init__(self, force):
+        self.force = force
+        self.force_used = False # the heater restart was decided with force
+        self.decided = False
+        self.messages = []
+        self.result = None
+        self.done = False
+        self.cond = threading.Condition()
+
+    @classmethod
+    def join(cls, force):
+        with cls.lock:
+            flight = cls.current
+            if flight and not flight.done and (not force or flight.upgrade()):
+                eprint("Joining the temperature query in flight")
+                return flight
+            flight = cls.current = Flight(force)
+        threading.Thread(target=flight.run, args=()).start()
+        return flight
+
+    def upgrade(self):
+        with self.cond:
+            if self.decided and not self.force_used:
+                return False
+            self.force = True
+            return True
+
+    def restart_is_fine(self):
+        with self.cond:
+            self.decided = True
+            self.force_used = bool(self.force)
+            return self.force
+
+    def _add(self, msg):
+        with self.cond:
+            self.messages.append(msg)
+            self.cond.notify_all()
+
+    def run(self):
+        re = (None, None, None, None)
+        try:
+            re = query_temperature(restart_is_fine=self.restart_is_fine, save_pix=True, callback=self._add)
+        except Exception as e:
+            eprint("Temperature query failed", e)
+        with self.cond:
+            self.result = re
+            self.done = True
+            self.cond.notify_all()
+
+    def follow(self):
+        """
+        Yields the progress messages, from the first one, until the query
+        is done; the result is in self.result then.
+        """
+        i = 0
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.done or len(self.messages) > i)
+                messages = self.messages[i:]
+                done = self.done
+            i += len(messages)
+            yield from messages
+            if done and i == len(self.messages):
+                return
+
 class StreamServer(BaseHTTPRequestHandler):
+    # keep-alive: every response has a Content-Length or is chunked, except
+    # /events that closes the connection; idle connections time out
+    protocol_version = "HTTP/1.1"
+    timeout = HTTP_TIMEOUT
 
     def _send_chunk(self, data=None):
         jsonstr = json.dumps(data)+"\n" if data else ""
         l = len(jsonstr)
         self.wfile.write('{:X}\r\n{}\r\n'.format(l, jsonstr).encode())
 
-    def _serve_file(self, basedir, content_type):
-        f = basedir + self.path
-        try:
-            file_stats = os.stat(f)
-        except:
-            self.send_response(404)
+    def _serve_file(self, basedir, content_type, immutable = False):
+        f = static_cache.get(basedir + self.path, content_type)
+        if f is None:
+            return self.e404()
+        # the captures never change, the assets are revalidated (cheaply, with the ETag)
+        cache_control = "public, max-age=31536000, immutable" if immutable else "no-cache"
+        (coding, body) = f.negotiate(self.headers.get("Accept-Encoding")) if f.data is not None else (None, None)
+        if self._not_modified(f.etags(), f.mtime):
+            self.send_response(304)
+            self.send_header("ETag", f.variant_etag(coding))
+            self.send_header("Cache-Control", cache_control)
+            if f.variants:
+                self.send_header("Vary", "Accept-Encoding")
             self.end_headers()
             return
         self.send_response(200)
         self.send_header("Content-type", content_type)
-        self.send_header("Content-Length", str(file_stats.st_size))
+        self.send_header("Content-Length", str(len(body) if body is not None else f.size))
+        self.send_header("ETag", f.variant_etag(coding))
+        self.send_header("Last-Modified", formatdate(f.mtime, usegmt=True))
+        self.send_header("Cache-Control", cache_control)
+        if f.variants:
+            self.send_header("Vary", "Accept-Encoding")
+        if coding:
+            self.send_header("Content-Encoding", coding)
         self.end_headers()
-        with open(f, "rb") as f:
-            data = f.read()
-            self.wfile.write(data)
+        if body is not None:
+            self.wfile.write(body)
+            return
+        with open(f.path, "rb") as fh:
+            if self.connection is None:
+                # asyncio front end, there is no socket of the thread
+                shutil.copyfileobj(fh, self.wfile, 256 * 1024)
+                return
+            # too big to be cached, straight from the page cache to the socket
+            self.wfile.flush()
+            self.connection.sendfile(fh, 0, f.size)
     
     def serve_pic(self):
-        return self._serve_file(DATADIR, "image/png")
+        return self._serve_file(DATADIR, "image/png", os.path.basename(self.path).startswith("water-"))
 
     def e404(self):
         self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def e400(self):
+        self.send_response(400)
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def serve_temperature(self):
@@ -239,57 +632,216 @@ class StreamServer(BaseHTTPRequestHandler):
         except:
             pass
 
-        re = query_temperature(restart_is_fine=payload["force"],save_pix=True,callback=acallback)
-        self._send_chunk({ "type": "html", "data": f"<a href='{re[1]}'><img src='{re[2]}'></a>" })
+        flight = Flight.join(payload["force"])
+        for msg in flight.follow():
+            acallback(msg)
+        re = flight.result
+        if re[1]:
+            self._send_chunk({ "type": "html", "data": f"<a href='{re[1]}'><img src='{re[2]}'></a>" })
         if re[0]:
             self._send_chunk({ "type": "result", "data": re[0] })
         self._send_chunk({ "type": "ready" })
         self._send_chunk()
 
     def _send_json_response(self, response):
+        data = json.dumps(response).encode()
         self.send_response(200)
         self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
         self.end_headers()
-        self.wfile.write(json.dumps(response).encode())  
+        self.wfile.write(data)
         
-    def _fetch_temp(self, limit = None, now = 0):
+    def _fetch_temp(self, limit = None, now = 0, since = None):
         if not now:
             now = int(time.time())
         n = now - 3 * 86400
         response = []
-        db = get_db()
-        for row in db.execute("SELECT ts*1000, temp FROM temperature WHERE ts > ? ORDER BY ts DESC " + (f"LIMIT {limit}" if limit else ""), (n,)):
-            response.append({"x":row[0], "y": row[1]})
+        with database.read() as db:
+            for row in db.execute("SELECT ts*1000, temp, rowid FROM temperature WHERE ts > ? AND rev > ? ORDER BY ts DESC " + (f"LIMIT {limit}" if limit else ""), (n, -1 if since is None else since)):
+                response.append({"x":row[0], "y": row[1], "id": row[2]})
         return response
     
-    def _fetch_energy(self, limit = None, now = 0):
+    def _fetch_energy(self, limit = None, now = 0, since = None):
         if not now:
             now = int(time.time())
         n = now - 3 * 86400
         response = []
-        db = get_db()
-        for row in db.execute("SELECT ts_start*1000, (ts_end-1)*1000, usage/10 FROM energy_data WHERE ts_start > ? ORDER BY ts_start " + (f"LIMIT {limit}" if limit else ""), (n,)):
-            response.append({"x":row[0], "y": row[2]})
-            response.append({"x":row[1], "y": row[2]})
+        with database.read() as db:
+            for row in db.execute("SELECT ts_start*1000, (ts_end-1)*1000, usage/10 FROM energy_data WHERE ts_start > ? AND rev > ? ORDER BY ts_start " + (f"LIMIT {limit}" if limit else ""), (n, -1 if since is None else since)):
+                response.append({"x":row[0], "y": row[2]})
+                response.append({"x":row[1], "y": row[2]})
         return response
     
     def serve_metadata(self):
-        db = get_db()
         response = {}
-        for row in db.execute("SELECT * FROM metadata"):
-            response[row[0]] = row[1]
+        with database.read() as db:
+            for row in db.execute("SELECT * FROM metadata"):
+                response[row[0]] = row[1]
         self._send_json_response(response)
 
-    def serve_fetch(self, limit = None):
-        now = int(time.time())
-        temp = self._fetch_temp(limit, now)
-        energy = self._fetch_energy(limit, now)
-        self._send_json_response({"temp": temp, "energy": energy})
+    def _not_modified(self, etags, modified):
+        # etags: the current ones of the resource (one per content coding)
+        inm = self.headers.get("If-None-Match")
+        if inm:
+            return any(t.strip() in etags for t in inm.split(",")) or inm.strip() == "*"
+        ims = self.headers.get("If-Modified-Since")
+        if ims:
+            try:
+                return modified <= parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                pass
+        return False
+
+    def serve_fetch(self, query = {}):
+        """
+        The last 3 days of temperature and energy data. With ?since=<rev>
+        (the rev of a previous response), only the points written after it:
+        temperature points replace the ones with the same id, energy points
+        the ones with the same x.
+        """
+        try:
+            since = int(query["since"][0]) if "since" in query else None
+        except ValueError:
+            return self.e400()
+        (rev, modified) = (data_rev, data_modified)
+        if since is not None and since > rev:
+            # a cursor of an other database, starting over
+            since = None
+        # the window moves by the hour, so the response only changes with the data
+        now = int(time.time()) // 3600 * 3600 + 3600
+        modified = max(modified, now - 3600)
+        etag = f'"{rev}-{now}-{since}"'
+        if self._not_modified([etag], modified):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        temp = self._fetch_temp(None, now, since)
+        energy = self._fetch_energy(None, now, since)
+        body = json.dumps({"temp": temp, "energy": energy, "rev": rev, "since": since}).encode()
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(modified, usegmt=True))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
     
+    def serve_range(self, query):
+        """
+        Temperature and energy between from and to (unix timestamps, the last
+        3 days by default). resolution is raw, hour, day or auto (picked by
+        the length of the range). Temperature points are the averages of the
+        buckets with their min and max, at most points of them (3 to
+        RANGE_MAX_POINTS, downsampled with LTTB); energy is the usage of the
+        buckets, in the unit of /fetch.
+        """
+        try:
+            to = int(query["to"][0]) if "to" in query else int(time.time())
+            frm = int(query["from"][0]) if "from" in query else to - 3 * 86400
+            points = min(max(int(query["points"][0]) if "points" in query else RANGE_POINTS, 3), RANGE_MAX_POINTS)
+        except ValueError:
+            return self.e400()
+        resolution = query["resolution"][0] if "resolution" in query else "auto"
+        if resolution == "auto":
+            span = to - frm
+            resolution = "raw" if span <= 7 * 86400 else "hour" if span <= 180 * 86400 else "day"
+        if resolution not in ["raw", "hour", "day"] or frm >= to:
+            return self.e400()
+
+        with database.read() as db:
+            if resolution == "raw":
+                rows = list(db.execute("SELECT ts, temp, temp, temp FROM temperature WHERE ts >= ? AND ts < ? ORDER BY ts", (frm, to)))
+                energy = list(db.execute("SELECT ts_start, usage FROM energy_data WHERE ts_start >= ? AND ts_start < ? ORDER BY ts_start", (frm, to)))
+            else:
+                table = "temperature_hourly" if resolution == "hour" else "temperature_daily"
+                rows = list(db.execute(f"SELECT ts, 1.0 * sum / count, min, max FROM {table} WHERE ts >= ? AND ts < ? ORDER BY ts", (frm, to)))
+                if resolution == "hour":
+                    energy = list(db.execute("SELECT ts_start, usage FROM energy_data WHERE ts_start >= ? AND ts_start < ? ORDER BY ts_start", (frm, to)))
+                else:
+                    energy = list(db.execute("SELECT ts, usage FROM energy_daily WHERE ts >= ? AND ts < ? ORDER BY ts", (frm, to)))
+        total = len(rows)
+        if total > points:
+            rows = [rows[i] for i in lttb([r[0] for r in rows], [r[1] for r in rows], points)]
+        self._send_json_response({
+            "from": frm,
+            "to": to,
+            "resolution": resolution,
+            "total": total,
+            "temp": [{"x": ts * 1000, "y": round(avg, 2), "min": mn, "max": mx} for (ts, avg, mn, mx) in rows],
+            "energy": [{"x": ts * 1000, "y": usage / 10} for (ts, usage) in energy],
+        })
+
+    def serve_events(self):
+        """
+        Server-Sent Events stream of the persisted readings ("temperature",
+        a point of /fetch), the changed energy data ("energy"), the metadata
+        ("metadata") and the progress messages of the queries ("progress").
+        The asyncio server answers it on the event loop (see stream_events).
+        """
+        s = events.subscribe()
+        if s is None:
+            self.send_response(503)
+            self.send_header("Retry-After", "60")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        try:
+            self.send_response(200)
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            # the stream ends with the connection
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(f"retry: {EVENTS_KEEPALIVE * 1000}\n\n".encode())
+            while True:
+                msg = s.get(EVENTS_KEEPALIVE)
+                if msg is None:
+                    if s.dropped:
+                        eprint("Dropping a slow event subscriber", self.client_address)
+                        break
+                    msg = b": keepalive\n\n"
+                self.wfile.write(msg)
+                self.wfile.flush()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            events.unsubscribe(s)
+
     def serve_latest(self):
         r = self._fetch_temp(1)[0]["y"]
         self._send_json_response(r)
 
+    def serve_ocrstats(self):
+        self._send_json_response(ocr_stats.snapshot())
+
+    def serve_schedule(self):
+        self._send_json_response(scheduler.schedule())
+
+    def serve_metrics(self):
+        data = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self):
+        # the label of the request in water_http_requests_total, of a bounded set of values
+        path = urlsplit(getattr(self, "path", "") or "").path
+        if path in ROUTES:
+            return path
+        if path.endswith(".png"):
+            return "*.png"
+        if os.path.splitext(path)[1] in static_extensions:
+            return "static"
+        return "other"
+
+    def send_response(self, code, message=None):
+        http_requests.labels(self.command, self.route(), code).inc()
+        super().send_response(code, message)
+
     def serve_live(self):
         r = {}
         if LIVE_STREAM_URL:
@@ -300,12 +852,17 @@ class StreamServer(BaseHTTPRequestHandler):
         if self.path == "/temperature":
             self.serve_temperature()
             return
-        self.e404()
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        # the body is not read, it must not be taken for the next request
+        self.send_header("Connection", "close")
+        self.end_headers()
 
     def do_GET(self):
         if self.path == "/":
             self.send_response(307)
             self.send_header("Location", "/index.html")
+            self.send_header("Content-Length", "0")
             self.end_headers()
             return
 
@@ -313,8 +870,17 @@ class StreamServer(BaseHTTPRequestHandler):
             self.serve_live()
             return
 
-        if self.path == "/fetch":
-            self.serve_fetch()
+        url = urlsplit(self.path)
+        if url.path == "/fetch":
+            self.serve_fetch(parse_qs(url.query))
+            return
+
+        if url.path == "/events":
+            self.serve_events()
+            return
+
+        if url.path == "/range":
+            self.serve_range(parse_qs(url.query))
             return
 
         if self.path == "/metadata":
@@ -325,6 +891,18 @@ class StreamServer(BaseHTTPRequestHandler):
             self.serve_latest()
             return
 
+        if self.path == "/ocrstats":
+            self.serve_ocrstats()
+            return
+
+        if self.path == "/metrics":
+            self.serve_metrics()
+            return
+
+        if self.path == "/schedule":
+            self.serve_schedule()
+            return
+
         if self.path.endswith(".png") and "?" not in self.path and ".." not in self.path:
             self.serve_pic()
             return
@@ -336,105 +914,165 @@ class StreamServer(BaseHTTPRequestHandler):
 
         self.e404()
 
-def get_db():
-    return sqlite3.connect(os.path.join(DATADIR, "water.db"))
+def day_sql(column, days=0):
+    # the start of the (local) day of a timestamp column, or of a day after it
+    return f"CAST(strftime('%s', {column}, 'unixepoch', 'localtime', 'start of day', '+{days} day', 'utc') AS INT)"
+
+# schema migrations, in order; never change the ones that were released, append new ones
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS temperature (ts INT, temp INT)",
+        "CREATE TABLE IF NOT EXISTS energy_data (ts_start INT PRIMARY KEY, ts_end INT, usage INT)",
+        "CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)",
+    ],
+    [
+        # the time range queries (/fetch, /latest, persisting a reading) would be full scans otherwise
+        "CREATE INDEX IF NOT EXISTS temperature_ts ON temperature (ts)",
+        "ANALYZE",
+    ],
+    [
+        # revision of the last write of the row, for /fetch?since=
+        "ALTER TABLE temperature ADD COLUMN rev INT NOT NULL DEFAULT 0",
+        "ALTER TABLE energy_data ADD COLUMN rev INT NOT NULL DEFAULT 0",
+    ],
+    [
+        # rollups for /range, see update_temperature_rollups and update_energy_rollups
+        "CREATE TABLE temperature_hourly (ts INT PRIMARY KEY, min INT, max INT, sum INT, count INT)",
+        "CREATE TABLE temperature_daily (ts INT PRIMARY KEY, min INT, max INT, sum INT, count INT)",
+        "CREATE TABLE energy_daily (ts INT PRIMARY KEY, usage INT)",
+        "INSERT INTO temperature_hourly SELECT ts / 3600 * 3600, min(temp), max(temp), sum(temp), count(*) FROM temperature GROUP BY 1",
+        f"INSERT INTO temperature_daily SELECT {day_sql('ts')}, min(min), max(max), sum(sum), sum(count) FROM temperature_hourly GROUP BY 1",
+        f"INSERT INTO energy_daily SELECT {day_sql('ts_start')}, sum(usage) FROM energy_data GROUP BY 1",
+    ],
+]
 
 def init_db():
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS temperature (ts INT, temp INT)")
-    cur.execute("CREATE TABLE IF NOT EXISTS energy_data (ts_start INT PRIMARY KEY, ts_end INT, usage INT)")
-    cur.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
-    db.commit()
-    eprint("Database initialized")
-
-def cron_thread():        
-    if PERIODIC_QUERY_CRON == "none":
-        eprint('Cron feature is disabled')
-        return
-    eprint('Cron thread started, only_when_unused is: '+str(PERIODIC_ONLY_WHEN_UNUSED))
+    global database, data_rev, last_rev
+    database = Database(DB_PATH, DB_READERS)
+    n = database.migrate(MIGRATIONS)
+    with database.read() as db:
+        data_rev = last_rev = db.execute("SELECT max((SELECT ifnull(max(rev), 0) FROM temperature), (SELECT ifnull(max(rev), 0) FROM energy_data))").fetchone()[0]
+    eprint("Database initialized", DB_PATH, f"({n} migrations applied)")
+
+def cron_job():
+    eprint('Running periodic query')
     only_when_unused = "unused" if PERIODIC_ONLY_WHEN_UNUSED else True
-    while True:
-        if pycron.is_now(PERIODIC_QUERY_CRON):
-            eprint('Running periodic query')
-            query_temperature(restart_is_fine=only_when_unused, save_pix=True)
-            time.sleep(60)               # The process should take at least 60 sec
-                                         # to avoid running twice in one minute
-        else:
-            time.sleep(15)               # Check again in 15 seconds
+    query_temperature(restart_is_fine=only_when_unused, save_pix=True)
 
-def mode333_thread():
-    eprint('Mode 333 thread started')
-    while True:
-        time.sleep(MODE_333)
-        while True:
-            eprint('Mode 333 query attempt')
-            x = query_temperature(restart_is_fine=False, save_pix=True)
-            if x[0]:
-                eprint('Mode 333 query attempt was successful:', x[0])
-                break
-            time.sleep(60)
-
-def cron_mode333_thread():
-    if MODE_333:
-        mode333_thread()
+def mode333_job():
+    eprint('Mode 333 query attempt')
+    x = query_temperature(restart_is_fine=False, save_pix=True)
+    if x[0]:
+        eprint('Mode 333 query attempt was successful:', x[0])
+        scheduler.call_later("mode333", MODE_333, mode333_job)
     else:
-        cron_thread()
-
-def energy_thread():
-    eprint('Energy thread started')
-    while True:
-        now = int(time.time())
-        if now % 3600 < 60:
-            eprint('Running energy usage query')
-            ts_end = int(now / 3600) * 3600
-            ts_start = ts_end - 3600
-            try:
-                p = subprocess.run([TAPOPLUG_PATH, TAPOPLUG_IP, str(ts_end-2), str(ts_end-1), "60"], stdout=subprocess.PIPE)
-                if p.returncode == 0:
-                    resp = json.loads(p.stdout)
-
-                    db = get_db()
-                    cur = db.cursor()
-                    
-                    for k in ["today_runtime", "month_runtime", "today_energy", "month_energy"]:
-                        v = resp["energy_usage"][k]
-                        cur.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES(?,?)", (k, v))
-
-                    dt = datetime.fromtimestamp(ts_end)                    
-                    # if the current time is 21:00, then we are interested in the energy usage between 20:00 and 21:00
-                    # that means, the slot in the return array should be 20
-                    ts_end_hour = dt.hour - 1
-                    # unless it is midnight, then we are looking for the energy usage of 23:00 -24:00 from yesterday, slot 23
-                    if ts_end_hour < 0:
-                        ts_end_hour = 23
-                    energy_usages_in_the_last_24h = resp["energy_data"]["data"]
-                    while ts_end_hour >= 0:
-                        usage = energy_usages_in_the_last_24h[ts_end_hour]
-                        eprint("energy usage", ts_start, ts_end, usage)
-                        cur.execute("INSERT OR REPLACE INTO energy_data (ts_start, ts_end, usage) VALUES(?,?,?)", (ts_start, ts_end, usage))
-                        ts_end_hour -= 1
-                        ts_start -= 3600
-                        ts_end -= 3600
-
-                    db.commit()
-                else:
-                    eprint("Failed to read energy data of the heater...")
-            except x:
-                eprint("error while retrieving energy data", x)
-            
-            time.sleep(60)               # The process should take at least 60 sec
-                                         # to avoid running twice in one minute
+        scheduler.call_later("mode333", 60, mode333_job)
+
+def energy_job():
+    now = int(time.time())
+    eprint('Running energy usage query')
+    ts_end = int(now / 3600) * 3600
+    ts_start = ts_end - 3600
+    try:
+        with plug_seconds.labels("energy").time():
+            p = subprocess.run([TAPOPLUG_PATH, TAPOPLUG_IP, str(ts_end-2), str(ts_end-1), "60"], stdout=subprocess.PIPE)
+        if p.returncode == 0:
+            resp = json.loads(p.stdout)
+
+            with db_write_seconds.labels("energy").time(), database.write() as db:
+                for k in ["today_runtime", "month_runtime", "today_energy", "month_energy"]:
+                    v = resp["energy_usage"][k]
+                    db.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES(?,?)", (k, v))
+
+                dt = datetime.fromtimestamp(ts_end)                    
+                # if the current time is 21:00, then we are interested in the energy usage between 20:00 and 21:00
+                # that means, the slot in the return array should be 20
+                ts_end_hour = dt.hour - 1
+                # unless it is midnight, then we are looking for the energy usage of 23:00 -24:00 from yesterday, slot 23
+                if ts_end_hour < 0:
+                    ts_end_hour = 23
+                energy_usages_in_the_last_24h = resp["energy_data"]["data"]
+                ts_end_day = ts_end
+                changes = db.total_changes
+                changed = False
+                while ts_end_hour >= 0:
+                    usage = energy_usages_in_the_last_24h[ts_end_hour]
+                    eprint("energy usage", ts_start, ts_end, usage)
+                    # the rows are only touched if they changed, so that /fetch?since= does not send them again
+                    db.execute("INSERT INTO energy_data (ts_start, ts_end, usage, rev) VALUES(?,?,?,?) "
+                               "ON CONFLICT (ts_start) DO UPDATE SET ts_end=excluded.ts_end, usage=excluded.usage, rev=excluded.rev "
+                               "WHERE ts_end != excluded.ts_end OR usage != excluded.usage", (ts_start, ts_end, usage, last_rev + 1))
+                    changed |= db.total_changes != changes
+                    changes = db.total_changes
+                    ts_end_hour -= 1
+                    ts_start -= 3600
+                    ts_end -= 3600
+                if changed:
+                    rev = next_rev()
+                    update_energy_rollups(db, ts_start + 3600, ts_end_day)
+            events.publish("metadata", {k: resp["energy_usage"][k] for k in ["today_runtime", "month_runtime", "today_energy", "month_energy"]})
+            if changed:
+                publish_rev(rev)
+                with database.read() as db:
+                    energy = [{"x": x, "y": y} for (start, end, y) in db.execute(
+                        "SELECT ts_start*1000, (ts_end-1)*1000, usage/10 FROM energy_data WHERE rev=? ORDER BY ts_start", (rev,)) for x in (start, end)]
+                events.publish("energy", {"points": energy, "rev": rev})
         else:
-            time.sleep(55)               # Check again later
+            eprint("Failed to read energy data of the heater...")
+    except Exception as x:
+        eprint("error while retrieving energy data", x)
+
+async def stream_events(writer):
+    """
+    StreamServer.serve_events of the asyncio server, on the event loop: an
+    open stream does not hold one of the HTTP_WORKERS threads.
+    """
+    s = events.subscribe(asyncio.get_running_loop())
+    code = 200 if s else 503
+    http_requests.labels("GET", "/events", code).inc()
+    date = formatdate(usegmt=True)
+    if s is None:
+        writer.write(f"HTTP/1.1 503 Service Unavailable\r\nDate: {date}\r\nRetry-After: 60\r\nContent-Length: 0\r\n\r\n".encode())
+        await asyncio.wait_for(writer.drain(), HTTP_TIMEOUT)
+        return
+    try:
+        # the stream ends with the connection
+        writer.write(f"HTTP/1.1 200 OK\r\nDate: {date}\r\nContent-type: text/event-stream\r\n"
+                     f"Cache-Control: no-cache\r\nConnection: close\r\n\r\nretry: {EVENTS_KEEPALIVE * 1000}\n\n".encode())
+        while True:
+            await asyncio.wait_for(writer.drain(), HTTP_TIMEOUT)
+            msg = await s.get(EVENTS_KEEPALIVE)
+            if msg is None:
+                if s.dropped:
+                    eprint("Dropping a slow event subscriber", writer.get_extra_info("peername"))
+                    break
+                msg = b": keepalive\n\n"
+            writer.write(msg)
+    finally:
+        events.unsubscribe(s)
 
 def main():
+    global grabber
     init_db()
-    threading.Thread(target=cron_mode333_thread, args=()).start()
-    threading.Thread(target=cleanup_thread, args=()).start()
-    threading.Thread(target=energy_thread, args=()).start()
-    server = ThreadingHTTPServer(("0.0.0.0", LISTEN_PORT), StreamServer)
-    eprint(f"server started on :{LISTEN_PORT}")
+    if PERSISTENT_GRABBER:
+        grabber = FrameGrabber(CAMURL, GRABBER_FRAMES).start()
+    if MODE_333:
+        eprint('Mode 333 is enabled')
+        scheduler.call_later("mode333", MODE_333, mode333_job)
+    elif PERIODIC_QUERY_CRON == "none":
+        eprint('Cron feature is disabled')
+    else:
+        eprint('Cron job scheduled, only_when_unused is: '+str(PERIODIC_ONLY_WHEN_UNUSED))
+        scheduler.cron("cron", PERIODIC_QUERY_CRON, cron_job)
+    scheduler.every("cleanup", CLEAN_SLEEP, cleanup_job)
+    # a missed hour would leave a hole in the energy data, it is made up for
+    scheduler.cron("energy", ENERGY_QUERY_CRON, energy_job, CATCHUP_ONCE)
+    scheduler.start()
+    if SERVER_MODE == "asyncio":
+        server = AsyncHTTPServer(StreamServer, ("0.0.0.0", LISTEN_PORT), HTTP_WORKERS, HTTP_TIMEOUT, {"/events": stream_events})
+    else:
+        server = ThreadingHTTPServer(("0.0.0.0", LISTEN_PORT), StreamServer)
+    eprint(f"{SERVER_MODE} server started on :{LISTEN_PORT}")
     server.serve_forever()
 
 
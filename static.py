@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# In-memory cache of the files served by the server (the dashboard assets and
+# the smaller captures), invalidated by their mtime, with precompressed
+# variants for the compressible ones.
+
+import os
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ["text/html", "application/javascript", "application/json", "text/css"]
+# appended to the ETag of the encoded variants, a strong validator differs between them
+ETAG_SUFFIXES = {"gzip": "gz", "br": "br"}
+
+class StaticFile:
+    def __init__(self, path, st, data=None, content_type=None):
+        self.path = path
+        self.mtime_ns = st.st_mtime_ns
+        self.mtime = int(st.st_mtime)
+        self.size = st.st_size
+        self.data = data # None if the file is too big to be cached, it is sent from the disk then
+        self.variants = {} # content coding -> compressed data
+        if data is None:
+            self.etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+            return
+        self.etag = '"' + hashlib.sha1(data).hexdigest()[:20] + '"'
+        if content_type in COMPRESSIBLE_TYPES:
+            variants = {"gzip": gzip.compress(data, 9, mtime=0)}
+            if brotli:
+                variants["br"] = brotli.compress(data)
+            # only worth it if they are smaller
+            self.variants = {k: v for (k, v) in variants.items() if len(v) < len(data)}
+
+    def variant_etag(self, coding):
+        if not coding:
+            return self.etag
+        return self.etag[:-1] + "-" + ETAG_SUFFIXES.get(coding, coding) + '"'
+
+    def etags(self):
+        # of all the variants
+        return [self.variant_etag(coding) for coding in [None] + list(self.variants)]
+
+    def cached_size(self):
+        return len(self.data or b"") + sum(len(v) for v in self.variants.values())
+
+    def negotiate(self, accept_encoding):
+        """
+        Returns the content coding (None for identity) and the body to send
+        for the Accept-Encoding header, the smallest acceptable variant.
+        """
+        accepted = set()
+        for token in (accept_encoding or "").split(","):
+            (coding, _, params) = token.strip().partition(";")
+            (name, _, q) = params.strip().partition("=")
+            try:
+                if name.strip() == "q" and float(q) == 0:
+                    continue
+            except ValueError:
+                continue
+            accepted.add(coding.strip().lower())
+        best = (None, self.data)
+        for (coding, body) in self.variants.items():
+            if (coding in accepted or "*" in accepted) and len(body) < len(best[1]):
+                best = (coding, body)
+        return best
+
+class StaticCache:
+    """
+    Files up to max_file bytes are kept in memory, up to max_total bytes
+    altogether (least recently used ones are dropped first). A file is
+    reloaded when its mtime or size changes.
+    """
+    def __init__(self, max_file=256 * 1024, max_total=16 * 1024 * 1024):
+        self.max_file = max_file
+        self.max_total = max_total
+        self.files = OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, content_type=None):
+        """
+        The StaticFile of the path, None if it does not exist.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            f = self.files.get(path)
+            if f and f.mtime_ns == st.st_mtime_ns and f.size == st.st_size:
+                self.files.move_to_end(path)
+                return f
+        if st.st_size > self.max_file:
+            return StaticFile(path, st)
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+        except OSError:
+            return None
+        if len(data) != st.st_size:
+            # it is being written, do not cache it
+            return StaticFile(path, os.stat(path), data, content_type)
+        f = StaticFile(path, st, data, content_type)
+        with self.lock:
+            old = self.files.pop(path, None)
+            if old:
+                self.total -= old.cached_size()
+            self.files[path] = f
+            self.total += f.cached_size()
+            while self.total > self.max_total and len(self.files) > 1:
+                (_, dropped) = self.files.popitem(last=False)
+                self.total -= dropped.cached_size()
+        return f